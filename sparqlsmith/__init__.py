@@ -8,6 +8,7 @@ from .query import (
     OrderBy,
     SubQuery,
     GroupGraphPattern,
+    QueryStatistics,
     extract_triple_patterns,
     check_if_triple_all_variables,
     get_combined_query,
@@ -27,6 +28,7 @@ __all__ = [
     "OrderBy",
     "SubQuery",
     "GroupGraphPattern",
+    "QueryStatistics",
     "extract_triple_patterns",
     "check_if_triple_all_variables",
     "get_combined_query",
@@ -1,4 +1,3 @@
-import networkx as nx
 from typing import List
 
 def determine_graph_shape(triples):
@@ -21,73 +20,94 @@ def determine_graph_shape(triples):
     if len(triples) == 1:
         return "Single-triple"
     
-    # Create a directed graph from the triples
-    G = nx.DiGraph()
-    
-    # Add edges for each triple (subject -> object via predicate)
+    # Number the nodes and collect the distinct directed edges (subject -> object),
+    # so the analysis below works on small ints instead of networkx graphs
+    ids = {}
+    edges = set()
     for triple in triples:
-        G.add_edge(triple.subject, triple.object, predicate=triple.predicate)
-    
-    # Create an undirected version for certain analyses
-    G_undirected = G.to_undirected()
-    
+        source = ids.setdefault(triple.subject, len(ids))
+        target = ids.setdefault(triple.object, len(ids))
+        edges.add((source, target))
+    n_nodes = len(ids)
+
+    out_degree = [0] * n_nodes
+    in_degree = [0] * n_nodes
+    # Undirected view: u -> v and v -> u are one edge, a self-loop counts twice
+    neighbors = [set() for _ in range(n_nodes)]
+    for source, target in edges:
+        out_degree[source] += 1
+        in_degree[target] += 1
+        neighbors[source].add(target)
+        neighbors[target].add(source)
+    degree = [len(adjacent) + (node in adjacent) for node, adjacent in enumerate(neighbors)]
+    n_undirected_edges = sum(degree) // 2
+
     # Check if it's a cycle
-    if len(G) == len(triples) and all(G.out_degree(n) == 1 and G.in_degree(n) == 1 for n in G.nodes):
+    if n_nodes == len(triples) and all(out_degree[n] == 1 and in_degree[n] == 1 for n in range(n_nodes)):
         return "Cycle"
-    
+
     # Check if it's a path (linear chain)
-    if all(G.out_degree(n) <= 1 and G.in_degree(n) <= 1 for n in G.nodes):
+    if all(out_degree[n] <= 1 and in_degree[n] <= 1 for n in range(n_nodes)):
         # A path should have exactly 2 endpoints
-        endpoints = [n for n in G.nodes if G.out_degree(n) + G.in_degree(n) == 1]
+        endpoints = [n for n in range(n_nodes) if out_degree[n] + in_degree[n] == 1]
         if len(endpoints) == 2:
             return "Path"
-    
+
     # Check if it's a star
-    degrees = [G_undirected.degree(n) for n in G_undirected.nodes]
-    if (len([d for d in degrees if d > 1]) == 1 and 
-        all(d == 1 or d > 2 for d in degrees)):
+    if (len([d for d in degree if d > 1]) == 1 and
+        all(d == 1 or d > 2 for d in degree)):
         return "Star"
-    
+
     # Check if it's a tree (connected and acyclic)
-    if nx.is_tree(G_undirected):
+    if n_undirected_edges == n_nodes - 1 and len(_component(neighbors, 0, None)) == n_nodes:
         # Find hub nodes (degree > 2)
-        hub_nodes = [n for n in G_undirected.nodes if G_undirected.degree(n) > 2]
-        
+        hub_nodes = [n for n in range(n_nodes) if degree[n] > 2]
+
         # If there are no hub nodes, it's a simple path
         if len(hub_nodes) == 0:
             return "Path"
-        
+
         # Check if it's a flower pattern - strict definition
         # A flower has exactly one hub node with one long stem path (length >= 2)
         if len(hub_nodes) == 1:
             hub_node = hub_nodes[0]
-            # Get neighbors of the hub
-            neighbors = list(G_undirected.neighbors(hub_node))
-            
+
             # We need one path of length >= 2 going out from the hub
             stems_found = 0
 
-            # Create a new graph without the hub to analyze each potential stem
-            H = G_undirected.copy()
-            H.remove_node(hub_node)
-            for neighbor in neighbors:
+            # Analyze each potential stem as the graph without the hub
+            for neighbor in neighbors[hub_node]:
                 # For each neighbor, find the connected component it belongs to
-                component = nx.node_connected_component(H, neighbor)
+                component = _component(neighbors, neighbor, hub_node)
                 # A stem is a path with length > 1
                 if len(component) > 1:
-                    # Check if this component forms a path
-                    subgraph = H.subgraph(component)
+                    # Degrees within the component: the graph is a tree, so the only
+                    # neighbor outside of it is the hub
+                    stem_degrees = [degree[n] - (hub_node in neighbors[n]) for n in component]
                     # A path has all nodes with degree <= 2 and exactly 2 nodes with degree 1
-                    if (all(subgraph.degree(n) <= 2 for n in subgraph.nodes) and
-                        len([n for n in subgraph.nodes if subgraph.degree(n) == 1]) == 2):
+                    if (all(d <= 2 for d in stem_degrees) and
+                        len([d for d in stem_degrees if d == 1]) == 2):
                         stems_found += 1
-            
+
             # A flower must have exactly one stem
             if stems_found == 1:
                 return "Flower"
-        
+
         # Default tree case
         return "Tree"
-    
+
     # If it has cycles but is not a simple cycle, it's complex
-    return "Complex" 
\ No newline at end of file
+    return "Complex"
+
+
+def _component(neighbors, start, excluded):
+    """The nodes reachable from ``start`` in the undirected graph without the node ``excluded``."""
+    seen = {start}
+    stack = [start]
+    while stack:
+        node = stack.pop()
+        for neighbor in neighbors[node]:
+            if neighbor != excluded and neighbor not in seen:
+                seen.add(neighbor)
+                stack.append(neighbor)
+    return seen
@@ -17,6 +17,12 @@ from .errors import OrderByValidationError
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# Types of the nested results pyparsing produces, for isinstance checks in hot loops
+_SEQUENCE_TYPES = (list, ParseResults)
+
+# ORDER BY direction keyword -> ascending flag
+_ORDER_DIRECTIONS = {'ASC': True, 'DESC': False}
+
 
 class SPARQLParser:
     """
@@ -44,7 +50,19 @@ class SPARQLParser:
         # Define the grammar
         self._define_grammar()
     
+    # Grammar elements by name; they hold no per-parser state, so they are built
+    # once and shared by all instances
+    _grammar = None
+
     def _define_grammar(self):
+        """Set up the SPARQL grammar, building it on first use."""
+        if SPARQLParser._grammar is None:
+            SPARQLParser._grammar = self._build_grammar()
+        for name, element in SPARQLParser._grammar.items():
+            setattr(self, name, element)
+
+    @staticmethod
+    def _build_grammar() -> Dict:
         """Define the SPARQL grammar using pyparsing."""
         # 1. Variable (e.g., ?x, ?name)
         variable = Combine(Literal('?') + Word(alphas, alphanums + '_'))
@@ -342,28 +360,30 @@ class SPARQLParser:
             Optional(offset_clause)
         )
         
-        # Save grammar elements as instance variables
-        self.variable = variable
-        self.iri = iri
-        self.term_s_p = term_s_p
-        self.term_o = term_o
-        self.triple_pattern = triple_pattern
-        self.bgp = bgp
-        self.filter_pattern = filter_pattern
-        self.braced_pattern = braced_pattern
-        self.optional_pattern = optional_pattern
-        self.union_pattern = union_pattern
-        self.where_clause = where_clause
-        self.select_clause = select_clause
-        self.order_by_clause = order_by_clause
-        self.group_by_clause = group_by_clause
-        self.having_pattern = having_pattern
-        self.agg_expression = agg_expression
-        self.prefix_decl = prefix_decl
-        self.prefix_section = prefix_section
-        self.limit_clause = limit_clause
-        self.offset_clause = offset_clause
-        self.query = query
+        # Grammar elements by the attribute names the parser uses
+        return {
+            'variable': variable,
+            'iri': iri,
+            'term_s_p': term_s_p,
+            'term_o': term_o,
+            'triple_pattern': triple_pattern,
+            'bgp': bgp,
+            'filter_pattern': filter_pattern,
+            'braced_pattern': braced_pattern,
+            'optional_pattern': optional_pattern,
+            'union_pattern': union_pattern,
+            'where_clause': where_clause,
+            'select_clause': select_clause,
+            'order_by_clause': order_by_clause,
+            'group_by_clause': group_by_clause,
+            'having_pattern': having_pattern,
+            'agg_expression': agg_expression,
+            'prefix_decl': prefix_decl,
+            'prefix_section': prefix_section,
+            'limit_clause': limit_clause,
+            'offset_clause': offset_clause,
+            'query': query,
+        }
     
     def parse(self, query_string: str) -> Dict:
         """
@@ -402,7 +422,7 @@ class SPARQLParser:
         """
         # For debugging
         if isinstance(result, ParseResults) and hasattr(result, 'keys'):
-            logger.debug(f"Result keys: {list(result.keys())}")
+            logger.debug("Result keys: %s", list(result.keys()))
         
         if isinstance(result, ParseResults):
             # Check if we have multiple patterns that should be preserved in order
@@ -491,14 +511,13 @@ class SPARQLParser:
                         i += 1
                     
                     # Case 2: Direction + variable in parentheses (e.g., DESC(?age))
-                    elif term in ['ASC', 'DESC'] and i+1 < len(result.order_by):
-                        direction = term
+                    elif isinstance(term, str) and term in _ORDER_DIRECTIONS and i+1 < len(result.order_by):
                         # Get the variable from the nested ParseResults
                         var_list = result.order_by[i+1]
                         if len(var_list) > 0:
                             var = var_list[0]
                             order_by_vars.append(var)
-                            ascending_flags.append(direction != 'DESC')
+                            ascending_flags.append(_ORDER_DIRECTIONS[term])
                         i += 2  # Skip the direction and variable group
                     else:
                         # Skip unrecognized terms
@@ -740,7 +759,7 @@ class SPARQLParser:
             A properly formatted HAVING expression string.
         """
         # For debugging
-        logger.debug(f"Formatting HAVING expression: {having_expr}")
+        logger.debug("Formatting HAVING expression: %s", having_expr)
         
         # Before attempting to parse, check if we already have a simple parsed expression
         if isinstance(having_expr, str):
@@ -765,7 +784,7 @@ class SPARQLParser:
                 having_expr = list(having_expr)
             
             # Handle single item that might be wrapped in a list
-            if len(having_expr) == 1 and isinstance(having_expr[0], (list, ParseResults)):
+            if len(having_expr) == 1 and isinstance(having_expr[0], _SEQUENCE_TYPES):
                 # For simple nested expressions, unwrap without adding parentheses
                 formatted = self._direct_format_having_part(having_expr[0])
                 # Remove any unnecessary outer parentheses for simple expressions
@@ -792,7 +811,7 @@ class SPARQLParser:
                 # Process all logical operations
                 while i < len(having_expr):
                     # Check if this is a logical operation
-                    if (isinstance(having_expr[i], (list, ParseResults)) and 
+                    if (isinstance(having_expr[i], _SEQUENCE_TYPES) and 
                         len(having_expr[i]) >= 2 and 
                         having_expr[i][0] in ['AND', 'OR', '&&', '||']):
                         
@@ -835,7 +854,7 @@ class SPARQLParser:
             return ""
             
         # Handle aggregation function directly
-        if isinstance(part, (list, ParseResults)) and len(part) >= 2:
+        if isinstance(part, _SEQUENCE_TYPES) and len(part) >= 2:
             # Check if it's an aggregation function
             if part[0] in ['COUNT', 'SUM', 'AVG', 'MIN', 'MAX']:
                 func = part[0]
@@ -843,7 +862,7 @@ class SPARQLParser:
                 return f"{func}({var})"
         
         # Handle comparison directly
-        if (isinstance(part, (list, ParseResults)) and 
+        if (isinstance(part, _SEQUENCE_TYPES) and 
             len(part) == 3 and 
             isinstance(part[1], str) and 
             part[1] in ['>', '<', '>=', '<=', '=', '!=']):
@@ -854,13 +873,13 @@ class SPARQLParser:
             return f"{left} {op} {right}"
         
         # Handle parenthesized expressions
-        if (isinstance(part, (list, ParseResults)) and
+        if (isinstance(part, _SEQUENCE_TYPES) and
             len(part) == 1 and
-            isinstance(part[0], (list, ParseResults))):
+            isinstance(part[0], _SEQUENCE_TYPES)):
             
             # Check if the inner part is a simple comparison that doesn't need parentheses
             inner_part = part[0]
-            if (isinstance(inner_part, (list, ParseResults)) and 
+            if (isinstance(inner_part, _SEQUENCE_TYPES) and 
                 len(inner_part) == 3 and 
                 isinstance(inner_part[1], str) and 
                 inner_part[1] in ['>', '<', '>=', '<=', '=', '!=']):
@@ -965,7 +984,7 @@ class SPARQLParser:
             prefixes = structured_dict['prefixes']
             
         # For debugging
-        logger.debug(f"Converting structured dict: {structured_dict}")
+        logger.debug("Converting structured dict: %s", structured_dict)
         
         # Extract top-level filters only
         # Filters inside patterns will be handled by _build_where_clause
@@ -1081,7 +1100,7 @@ class SPARQLParser:
         Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List]
             The corresponding WHERE clause object.
         """
-        logger.debug(f"Building where clause from: {structured_dict}")
+        logger.debug("Building where clause from: %s", structured_dict)
         
         # Handle patterns list (multiple patterns in order)
         if 'patterns' in structured_dict:
@@ -1256,7 +1275,7 @@ class SPARQLParser:
         """
         try:
             structured_dict = self.parse(query_string)
-            logger.debug(f"Structured dict: {structured_dict}")
+            logger.debug("Structured dict: %s", structured_dict)
             return self.structured_dict_to_query(structured_dict)
         except Exception as e:
             logger.error(f"Error parsing to query: {str(e)}")
@@ -1,8 +1,11 @@
-from dataclasses import dataclass, field
-from typing import List, Union, Dict, Optional, Set
-import copy
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from operator import attrgetter
+from typing import List, Union, Dict, Optional, Set, Tuple
+import hashlib
 import random
 import re
+import sys
 import logging
 from collections import defaultdict
 import networkx as nx
@@ -13,7 +16,196 @@ from .graph_analysis import determine_graph_shape
 logging.basicConfig(level=logging.INFO)
 
 
-@dataclass
+def _remove_identical(items, item) -> bool:
+    """Remove ``item`` from ``items`` by identity rather than by value equality."""
+    if not items:
+        return False
+    # list.index tests identity before equality and the query components compare
+    # by identity, so the scan normally stays in C; confirm the hit regardless
+    try:
+        index = items.index(item)
+    except ValueError:
+        return False
+    if items[index] is not item:
+        index = next((i for i, candidate in enumerate(items) if candidate is item), None)
+        if index is None:
+            return False
+    del items[index]
+    return True
+
+
+def _intern(term):
+    """Intern ``term`` if it is a plain string; other values are returned unchanged."""
+    return sys.intern(term) if type(term) is str else term
+
+
+# (subject, predicate, object) of a triple pattern
+_triple_terms = attrgetter('subject', 'predicate', 'object')
+
+
+# Matches IRIs and string literals as well as variables, capturing the variable name,
+# so that variables can be found in expressions without looking inside IRIs and literals.
+# IRIs are limited to the characters SPARQL allows in them and may not start with a
+# variable, so that an unspaced comparison like ?a<?b && ?c>3 is not taken for an IRI.
+_CANONICAL_TOKEN = re.compile(
+    r'<(?![?$])[^<>"{}|^`\\\x00-\x20]*>|"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[?$](\w+)'
+)
+
+
+def _expression_variables(expression: str) -> List[str]:
+    """Return the variables used in a filter expression, with the '?' prefix."""
+    return ['?' + name for name in _CANONICAL_TOKEN.findall(expression) if name]
+
+
+@lru_cache(maxsize=64)
+def _spaces(n: int) -> str:
+    """Return ``n`` spaces; cached, as the same few indentation widths are used over and over."""
+    return " " * n
+
+
+def _triple_signature(triple) -> tuple:
+    """
+    The shape of a triple pattern up to variable renaming: its constants, with None
+    for each variable position. Only triples with equal signatures can be matched
+    onto each other in an isomorphism check.
+    """
+    return tuple(
+        None if isinstance(term, str) and term[:1] == '?' else term
+        for term in (triple.subject, triple.predicate, triple.object)
+    )
+
+
+def _refine_variable_colors(triples1: list, triples2: list) -> tuple:
+    """
+    Color the variables of two lists of triple patterns by color refinement
+    (1-dimensional Weisfeiler-Leman).
+
+    All variables start with the same color; in each round a variable's new color
+    combines its old color with the triple patterns it occurs in, the other
+    variables there replaced by their colors. Both lists are refined for the same
+    number of rounds, until neither partition gets finer, so their colors are
+    comparable: an isomorphism between the lists can only map a variable to one
+    of the same color. Colors are keyed by the variable name without '?'.
+
+    A new color is the rank of the variable's signature among the signatures of
+    both lists, so colors do not depend on variable names, triple order or the
+    hash seed; ``canonical_key`` uses this to order triples.
+    """
+    colors = []
+    for triples in (triples1, triples2):
+        colors.append({
+            term[1:]: 0
+            for triple in triples for term in (triple.subject, triple.predicate, triple.object)
+            if isinstance(term, str) and term[:1] == '?'
+        })
+    for _ in range(max(len(colors[0]), len(colors[1])) + 1):
+        refined = []
+        for triples, old in zip((triples1, triples2), colors):
+            incidences = {var: [] for var in old}
+            for triple in triples:
+                terms = (triple.subject, triple.predicate, triple.object)
+                is_var = [isinstance(term, str) and term[:1] == '?' for term in terms]
+                # Constants are tagged with their type so that sorting never compares e.g. int and str
+                colored = tuple(
+                    (1, old[term[1:]]) if var else (0, type(term).__name__, str(term))
+                    for term, var in zip(terms, is_var)
+                )
+                for position, term in enumerate(terms):
+                    if is_var[position]:
+                        incidences[term[1:]].append((position, colored))
+            refined.append({var: (old[var], tuple(sorted(incidence))) for var, incidence in incidences.items()})
+        signatures = sorted(set(refined[0].values()) | set(refined[1].values()))
+        ranks = {signature: rank for rank, signature in enumerate(signatures)}
+        refined = [{var: ranks[signature] for var, signature in new.items()} for new in refined]
+        if all(len(set(new.values())) <= len(set(old.values())) for new, old in zip(refined, colors)):
+            break  # Stable partitions
+        colors = refined
+    return colors[0], colors[1]
+
+
+def _clause_invariant(clause) -> tuple:
+    """
+    Summary of a where clause, or part of it, that is invariant under variable
+    renaming, triple order and UNION operand order: its type, the number of BGPs
+    and the multiset of triple signatures, including those in subqueries. Only
+    clauses with equal invariants can be isomorphic.
+    """
+    n_bgps = 0
+    signatures = defaultdict(int)
+    for component in _iter_clauses(clause, into_subqueries=True):
+        if isinstance(component, BGP):
+            n_bgps += 1
+            for triple in component.triples:
+                signatures[_triple_signature(triple)] += 1
+    return type(clause), n_bgps, frozenset(signatures.items())
+
+
+class _VariableMapping:
+    """
+    The injective variable mapping built up during an isomorphism check.
+
+    Every new binding is recorded in an undo log, so that a failed branch of the
+    search is rolled back with ``rollback(mark)`` instead of working on copies.
+    If variable colors from ``_refine_variable_colors`` are given, only variables
+    of the same color can be bound to each other.
+    """
+    __slots__ = ('forward', 'mapped_to', 'trail', 'colors1', 'colors2')
+
+    def __init__(self, colors1: Dict[str, int] = None, colors2: Dict[str, int] = None):
+        self.forward = {}
+        self.mapped_to = set()
+        self.trail = []
+        self.colors1 = colors1
+        self.colors2 = colors2
+
+    def bind(self, var1: str, var2: str) -> bool:
+        """Map ``var1`` to ``var2``; returns False if that conflicts with an existing binding."""
+        bound = self.forward.get(var1)
+        if bound is not None:
+            return bound == var2
+        if var2 in self.mapped_to:
+            return False  # var2 is already mapped to a different variable
+        if self.colors1 is not None and self.colors1.get(var1) != self.colors2.get(var2):
+            return False
+        self.forward[var1] = var2
+        self.mapped_to.add(var2)
+        self.trail.append(var1)
+        return True
+
+    def mark(self) -> int:
+        return len(self.trail)
+
+    def rollback(self, mark: int):
+        """Undo all bindings made since ``mark`` was taken."""
+        forward, mapped_to, trail = self.forward, self.mapped_to, self.trail
+        while len(trail) > mark:
+            mapped_to.discard(forward.pop(trail.pop()))
+
+
+def _slotted(cls=None, *, parent: bool = True):
+    """
+    Recreate a dataclass with ``__slots__`` for its fields and its parent reference.
+
+    Equivalent to ``@dataclass(slots=True)``, which requires Python 3.10. Slots
+    declared in the class body for non-field attributes are kept. Classes that are
+    never part of a query tree use ``@_slotted(parent=False)`` to leave out the
+    parent reference.
+    """
+    if cls is None:
+        return lambda cls: _slotted(cls, parent=parent)
+    names = tuple(f.name for f in fields(cls)) + tuple(cls.__dict__.get('__slots__', ()))
+    if parent and '_parent' not in names:
+        names += ('_parent',)
+    namespace = {
+        key: value for key, value in cls.__dict__.items()
+        if key not in names and key not in ('__dict__', '__weakref__', '__slots__')
+    }
+    namespace['__slots__'] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@_slotted
+@dataclass(eq=False)
 class TriplePattern:
     """
     Represents a triple pattern in a SPARQL query.
@@ -30,8 +222,53 @@ class TriplePattern:
     subject: str
     predicate: str
     object: str
-    _parent: 'BGP' = None  # Reference to parent BGP
+    _parent: 'BGP' = field(default=None, repr=False)  # Reference to parent BGP
+    # Cached variables of the pattern and the (subject, predicate, object) they were computed from
+    __slots__ = ('_vars', '_vars_terms')
+
+    def __post_init__(self):
+        # Intern the terms so repeated variables and IRIs share one string object
+        try:
+            self.subject = sys.intern(self.subject)
+            self.predicate = sys.intern(self.predicate)
+            self.object = sys.intern(self.object)
+        except TypeError:  # Non-string term, e.g. a numeric literal from the parser
+            self.subject = _intern(self.subject)
+            self.predicate = _intern(self.predicate)
+            self.object = _intern(self.object)
+
+    @property
+    def vars(self) -> frozenset:
+        """
+        The variables occurring in this triple pattern.
+
+        Computed once and reused until subject, predicate or object change.
+
+        Returns
+        -------
+        frozenset
+            The variable names (including the '?' prefix).
+        """
+        terms = (self.subject, self.predicate, self.object)
+        try:
+            cached_terms = self._vars_terms
+        except AttributeError:  # Not computed yet
+            cached_terms = None
+        if terms != cached_terms:
+            self._vars = frozenset(term for term in terms if isinstance(term, str) and term[:1] == '?')
+            self._vars_terms = terms
+        return self._vars
     
+    def _clone(self) -> 'TriplePattern':
+        """Return a copy of this triple pattern without a parent."""
+        # The terms are interned already, so __init__ and __post_init__ are skipped
+        clone = object.__new__(type(self))
+        clone.subject = self.subject
+        clone.predicate = self.predicate
+        clone.object = self.object
+        clone._parent = None
+        return clone
+
     def remove(self):
         """
         Remove this triple pattern from its parent BGP.
@@ -41,10 +278,7 @@ class TriplePattern:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is not None and self in self._parent.triples:
-            self._parent.triples.remove(self)
-            return True
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
 
 
 class BGP:
@@ -57,9 +291,12 @@ class BGP:
         A list of triple patterns that make up the BGP.
     filters : List['Filter']
         A list of filters that apply to this BGP.
+    dedup : bool
+        Whether duplicate triple patterns are dropped on construction and skipped by ``add``.
     """
+    __slots__ = ('triples', 'filters', 'dedup', '_triple_index', '_shape', '_shape_key', '_parent')
 
-    def __init__(self, triples: List[TriplePattern] = None, filters: List['Filter'] = None):
+    def __init__(self, triples: List[TriplePattern] = None, filters: List['Filter'] = None, dedup: bool = False):
         """
         Initialize a BGP object.
 
@@ -69,8 +306,21 @@ class BGP:
             A list of triple patterns to initialize the BGP with (default is None).
         filters : List['Filter'], optional
             A list of filters to initialize the BGP with (default is None).
+        dedup : bool, optional
+            Whether triple patterns with the same subject, predicate and object as
+            one already in the BGP are skipped, both in ``triples`` and by ``add``
+            (default is False).
         """
         self.triples = triples if triples is not None else []
+        self._triple_index = None  # (s, p, o) -> TriplePattern, built lazily for dedup
+        if dedup and self.triples:
+            # Keep the first of each group of equal triple patterns
+            index = {}
+            for triple in self.triples:
+                index.setdefault(_triple_terms(triple), triple)
+            if len(index) < len(self.triples):
+                self.triples = list(index.values())
+            self._triple_index = index
         # Set parent reference for each triple
         for triple in self.triples:
             triple._parent = self
@@ -80,8 +330,39 @@ class BGP:
         for filter in self.filters:
             filter._parent = self
             
+        self.dedup = dedup
+        self._shape = None  # Computed by shape
+        self._shape_key = None
         self._parent = None  # Reference to parent query or operator
     
+    @classmethod
+    def from_arrays(cls, subjects, predicates, objects) -> 'BGP':
+        """
+        Build a BGP from parallel sequences of subjects, predicates and objects.
+
+        Parameters
+        ----------
+        subjects, predicates, objects : Sequence
+            The terms of the triple patterns; the i-th triple pattern is
+            (subjects[i], predicates[i], objects[i]).
+
+        Returns
+        -------
+        BGP
+            A new BGP with one triple pattern per position.
+
+        Raises
+        ------
+        ValueError
+            If the sequences differ in length.
+        """
+        if not len(subjects) == len(predicates) == len(objects):
+            raise ValueError("subjects, predicates and objects must have the same length")
+        bgp = cls()
+        # Positional construction with the parent passed in, as in add_triple
+        bgp.triples = [TriplePattern(s, p, o, bgp) for s, p, o in zip(subjects, predicates, objects)]
+        return bgp
+
     def shape(self):
         """
         Determine the shape of the graph formed by the triples in this BGP.
@@ -96,12 +377,78 @@ class BGP:
         - Flower: A stem path with the end having several outgoing paths
         - Complex: Any other graph structure
         
+        The shape is computed once and reused until the subjects or objects of the
+        triple patterns change.
+
         Returns
         -------
         str
             The shape name as a string
         """
-        return determine_graph_shape(self.triples)
+        # The shape only depends on the subject -> object edges
+        key = tuple((triple.subject, triple.object) for triple in self.triples)
+        if key != self._shape_key:
+            self._shape = determine_graph_shape(self.triples)
+            self._shape_key = key
+        return self._shape
+
+    def reorder_by_selectivity(self, stats: Optional[Dict[str, int]] = None) -> 'BGP':
+        """
+        Reorder the triple patterns of this BGP for evaluation, most selective first.
+
+        A greedy join-order heuristic: triples with fewer variables are assumed
+        to be more selective and are placed first. After the first triple, the
+        next triple is always chosen among those that share a variable with the
+        triples placed so far, so that no cross products are introduced unless
+        the BGP is disconnected.
+
+        Parameters
+        ----------
+        stats : Union[Dict[str, int], QueryStatistics], optional
+            Cardinalities per predicate, or query statistics, used to break ties
+            between triples with the same number of variables. Triples without
+            statistics are ordered after those with statistics. If omitted, the
+            statistics attached to the enclosing query with ``stats_hint`` are used.
+
+        Returns
+        -------
+        BGP
+            self, with its triples reordered in place.
+        """
+        if len(self.triples) < 2:
+            return self
+
+        if stats is None:
+            stats = _enclosing_statistics(self._parent)
+        if isinstance(stats, QueryStatistics):
+            cardinality_of = stats.cardinality
+        elif stats is not None:
+            cardinality_of = lambda triple: stats.get(triple.predicate)
+
+        def selectivity_key(indexed_triple):
+            index, triple = indexed_triple
+            n_variables = len(triple.vars)
+            if stats is None:
+                return (n_variables, index)
+            cardinality = cardinality_of(triple)
+            return (n_variables, cardinality is None, cardinality or 0, index)
+
+        remaining = sorted(enumerate(self.triples), key=selectivity_key)
+        ordered = []
+        bound_variables = set()
+        while remaining:
+            # remaining is sorted, so the first connected triple is the most selective one
+            position = next(
+                (i for i, (_, triple) in enumerate(remaining) if not bound_variables.isdisjoint(triple.vars)),
+                0
+            )
+            _, triple = remaining.pop(position)
+            ordered.append(triple)
+            bound_variables.update(triple.vars)
+
+        self.triples[:] = ordered
+        self._triple_index = None
+        return self
         
     def add(self, component):
         """
@@ -118,7 +465,8 @@ class BGP:
             
         Returns
         -------
-        The added component object
+        The added component object. If ``dedup`` is enabled and an equal triple
+        pattern is already part of the BGP, that existing triple pattern.
         
         Raises
         ------
@@ -127,15 +475,16 @@ class BGP:
         """
         # Handle tuple case (s, p, o)
         if isinstance(component, tuple) and len(component) == 3:
-            triple = TriplePattern(subject=component[0], predicate=component[1], object=component[2])
-            triple._parent = self
-            self.triples.append(triple)
-            return triple
+            return self.add_triple(component[0], component[1], component[2])
             
         # Handle TriplePattern case
         elif isinstance(component, TriplePattern):
+            if self.dedup:
+                existing = self._find_triple((component.subject, component.predicate, component.object))
+                if existing is not None:
+                    return existing
             component._parent = self
-            self.triples.append(component)
+            self._append_triple(component)
             return component
             
         # Handle Filter case
@@ -146,14 +495,91 @@ class BGP:
             
         # Handle string case (filter expression)
         elif isinstance(component, str):
-            filter = Filter(expression=component)
-            filter._parent = self
-            self.filters.append(filter)
-            return filter
+            return self.add_filter_expr(component)
             
         else:
             raise TypeError(f"Cannot add component of type {type(component)} to BGP")
-        
+
+    def add_triple(self, subject, predicate, object) -> TriplePattern:
+        """
+        Add the triple pattern (subject, predicate, object) to this BGP.
+
+        Same as ``add((subject, predicate, object))`` without the type dispatch;
+        prefer it when building BGPs in a loop.
+
+        Returns
+        -------
+        TriplePattern
+            The added triple pattern. If ``dedup`` is enabled and an equal triple
+            pattern is already part of the BGP, that existing triple pattern.
+        """
+        if self.dedup:
+            existing = self._find_triple((subject, predicate, object))
+            if existing is not None:
+                return existing
+        # Positional construction with the parent passed in directly is the cheapest way
+        # to build a TriplePattern; copying a cached prototype is several times slower
+        triple = TriplePattern(subject, predicate, object, self)
+        self._append_triple(triple)
+        return triple
+
+    def add_filter_expr(self, expression: str) -> 'Filter':
+        """
+        Add a filter with the given expression to this BGP.
+
+        Same as ``add(expression)`` without the type dispatch.
+
+        Returns
+        -------
+        Filter
+            The added filter.
+        """
+        filter = Filter(expression=expression)
+        filter._parent = self
+        self.filters.append(filter)
+        return filter
+
+    def reindex(self):
+        """
+        Rebuild the index ``add`` uses to skip duplicates when ``dedup`` is set.
+
+        The index follows ``add``, ``remove`` and ``SPARQLQuery.instantiate``. Call this
+        after changing the terms of triple patterns in place or after changing
+        ``triples`` directly, otherwise ``add`` may not recognize a duplicate.
+        """
+        index = {}
+        for triple in self.triples:
+            index.setdefault(_triple_terms(triple), triple)
+        self._triple_index = index
+
+    def _find_triple(self, key: tuple) -> Optional[TriplePattern]:
+        """Return the triple pattern of this BGP with the given (s, p, o), if any."""
+        if self._triple_index is None:
+            self.reindex()
+        existing = self._triple_index.get(key)
+        if existing is not None and (_triple_terms(existing) != key or existing._parent is not self):
+            # The triple was modified or removed since it was indexed
+            self.reindex()
+            existing = self._triple_index.get(key)
+        return existing
+
+    def _append_triple(self, triple: TriplePattern):
+        self.triples.append(triple)
+        if self._triple_index is not None:
+            self._triple_index.setdefault(_triple_terms(triple), triple)
+        _shift_triple_count(self._parent, 1)
+        
+    def _clone(self) -> 'BGP':
+        """Return a copy of this BGP and its triple patterns and filters, without a parent."""
+        clone = BGP(
+            [triple._clone() for triple in self.triples],
+            [filter._clone() for filter in self.filters],
+            self.dedup
+        )
+        clone._shape = self._shape
+        clone._shape_key = self._shape_key
+        return clone
+
     def remove(self):
         """
         Remove this BGP from its parent container (query or operator).
@@ -163,35 +589,19 @@ class BGP:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.where_clause == self:
-                self._parent.where_clause = None
-                return True
-            elif isinstance(self._parent.where_clause, list) and self in self._parent.where_clause:
-                self._parent.where_clause.remove(self)
-                return True
-        elif isinstance(self._parent, OptionalOperator):
-            if self._parent.bgp == self:
-                self._parent.bgp = None
-                self._parent.remove()  # Remove the optional operator as it's no longer valid
-                return True
-        elif isinstance(self._parent, (UnionOperator, GroupGraphPattern)):
-            if self._parent.left == self:
-                self._parent.left = None
-                self._parent.remove()  # Remove the union/group as it's no longer valid
-                return True
-            elif self._parent.right == self:
-                self._parent.right = None
-                self._parent.remove()  # Remove the union/group as it's no longer valid
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
+
+    def _detach_child(self, child) -> bool:
+        """Detach a triple pattern or filter from this BGP."""
+        if _remove_identical(self.triples, child):
+            self._triple_index = None
+            _shift_triple_count(self._parent, -1)
+            return True
+        return _remove_identical(self.filters, child)
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class UnionOperator:
     """
     Represents a UNION operator in a SPARQL query.
@@ -200,15 +610,38 @@ class UnionOperator:
     
     left: Union['BGP', 'OptionalOperator', 'UnionOperator', 'SubQuery']
     right: Union['BGP', 'OptionalOperator', 'UnionOperator', 'SubQuery']
-    _parent = None  # Reference to parent container
-    
+
     def __post_init__(self):
+        self._parent = None  # Reference to parent container
         # Set parent references
         if hasattr(self.left, '_parent'):
             self.left._parent = self
         if hasattr(self.right, '_parent'):
             self.right._parent = self
             
+    def _clone(self) -> 'UnionOperator':
+        """Return a copy of this UNION and its operands, without a parent."""
+        return _clone_clause(self)
+
+    @property
+    def branches(self) -> list:
+        """
+        The operands of this UNION and of the UNIONs directly nested in it, left to right.
+
+        ``A UNION B UNION C`` is stored as nested binary operators; this gives the
+        flat N-ary view ``[A, B, C]`` regardless of how the operators are nested.
+        """
+        branches = []
+        stack = [self.right, self.left]
+        while stack:
+            operand = stack.pop()
+            if isinstance(operand, UnionOperator):
+                stack.append(operand.right)
+                stack.append(operand.left)
+            else:
+                branches.append(operand)
+        return branches
+
     def remove(self):
         """
         Remove this union operator from its parent container.
@@ -218,26 +651,23 @@ class UnionOperator:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
+        return self._parent is not None and self._parent._detach_child(self)
+
+    def _detach_child(self, child) -> bool:
+        """Detach an operand; a UNION missing an operand is removed as well."""
+        if child is self.left:
+            self.left = None
+        elif child is self.right:
+            self.right = None
+        else:
             return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.where_clause == self:
-                self._parent.where_clause = None
-                return True
-            elif isinstance(self._parent.where_clause, list) and self in self._parent.where_clause:
-                self._parent.where_clause.remove(self)
-                return True
-        elif isinstance(self._parent, GroupGraphPattern):
-            if self._parent.pattern == self:
-                self._parent.pattern = None
-                self._parent.remove()  # Remove the group as it's no longer valid
-                return True
-                
-        return False
+        _shift_triple_count(self, -_walk_where(child))
+        self.remove()  # Remove the union as it's no longer valid
+        return True
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class OptionalOperator:
     """
     Represents an OPTIONAL pattern in a SPARQL query.
@@ -248,13 +678,17 @@ class OptionalOperator:
         The graph pattern that is optionally matched.
     """
     bgp: Union['BGP', 'UnionOperator', 'SubQuery']
-    _parent = None  # Reference to parent container
-    
+
     def __post_init__(self):
+        self._parent = None  # Reference to parent container
         # Set parent reference
         if hasattr(self.bgp, '_parent'):
             self.bgp._parent = self
             
+    def _clone(self) -> 'OptionalOperator':
+        """Return a copy of this OPTIONAL and its pattern, without a parent."""
+        return _clone_clause(self)
+
     def remove(self):
         """
         Remove this optional operator from its parent container.
@@ -264,26 +698,20 @@ class OptionalOperator:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
+        return self._parent is not None and self._parent._detach_child(self)
+
+    def _detach_child(self, child) -> bool:
+        """Detach the optional pattern; the now empty OPTIONAL is removed as well."""
+        if child is not self.bgp:
             return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.where_clause == self:
-                self._parent.where_clause = None
-                return True
-            elif isinstance(self._parent.where_clause, list) and self in self._parent.where_clause:
-                self._parent.where_clause.remove(self)
-                return True
-        elif isinstance(self._parent, GroupGraphPattern):
-            if self._parent.pattern == self:
-                self._parent.pattern = None
-                self._parent.remove()  # Remove the group as it's no longer valid
-                return True
-                
-        return False
+        _shift_triple_count(self, -_walk_where(child))
+        self.bgp = None
+        self.remove()  # Remove the optional operator as it's no longer valid
+        return True
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class Filter:
     """
     Represents a FILTER expression in a SPARQL query.
@@ -294,8 +722,15 @@ class Filter:
         The filter expression.
     """
     expression: str
-    _parent = None  # Reference to parent BGP or query
+
+    def __post_init__(self):
+        self._parent = None  # Reference to parent BGP or query
+        self.expression = _intern(self.expression)
     
+    def _clone(self) -> 'Filter':
+        """Return a copy of this filter without a parent."""
+        return Filter(self.expression)
+
     def remove(self):
         """
         Remove this filter from its parent container.
@@ -305,26 +740,11 @@ class Filter:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, BGP):
-            if self in self._parent.filters:
-                self._parent.filters.remove(self)
-                return True
-        elif isinstance(self._parent, SPARQLQuery):
-            if self._parent.filters and self in self._parent.filters:
-                self._parent.filters.remove(self)
-                return True
-        elif isinstance(self._parent, GroupGraphPattern):
-            if self in self._parent.filters:
-                self._parent.filters.remove(self)
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class Having:
     """
     Represents a HAVING condition in a SPARQL query.
@@ -335,8 +755,14 @@ class Having:
         The expression to filter groups after aggregation.
     """
     expression: str
-    _parent = None  # Reference to parent query
+
+    def __post_init__(self):
+        self._parent = None  # Reference to parent query
     
+    def _clone(self) -> 'Having':
+        """Return a copy of this HAVING condition without a parent."""
+        return Having(self.expression)
+
     def remove(self):
         """
         Remove this HAVING condition from its parent query.
@@ -346,18 +772,11 @@ class Having:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.having and self in self._parent.having:
-                self._parent.having.remove(self)
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class OrderBy:
     """
     Represents an ORDER BY clause in a SPARQL query.
@@ -366,11 +785,19 @@ class OrderBy:
     ----------
     variables: List[str]
         The variables to order by.
+    ascending: Union[bool, List[bool]]
+        The sort direction: a single bool for all variables, or one flag per
+        variable. Variables without a flag are sorted in ascending order.
     """
 
     variables: List[str]
     ascending: Union[bool, List[bool]] = True
-    _parent = None  # Reference to parent query
+
+    def __post_init__(self):
+        self._parent = None  # Reference to parent query
+        self.variables = [_intern(variable) for variable in self.variables]
+        if not isinstance(self.ascending, bool):
+            self.ascending = list(self.ascending)
     
     def add(self, variable, ascending=True):
         """
@@ -388,20 +815,21 @@ class OrderBy:
         self
             For method chaining
         """
-        self.variables.append(variable)
-        
-        # Handle the ascending flag
-        if isinstance(self.ascending, bool):
-            # Convert to list if it was a single boolean
-            if len(self.variables) > 1:
-                self.ascending = [self.ascending] * (len(self.variables) - 1)
-                self.ascending.append(ascending)
-        else:
-            # Already a list, just append
+        self.variables.append(_intern(variable))
+        if not isinstance(self.ascending, bool):
             self.ascending.append(ascending)
-            
+        elif len(self.variables) == 1:
+            # The first variable sets the direction
+            self.ascending = ascending
+        else:
+            # Expand the single direction to one flag per variable
+            self.ascending = [self.ascending] * (len(self.variables) - 1) + [ascending]
         return self
     
+    def _clone(self) -> 'OrderBy':
+        """Return a copy of this ORDER BY clause without a parent."""
+        return OrderBy(self.variables, self.ascending)  # __post_init__ copies the lists
+
     def remove(self):
         """
         Remove this ORDER BY clause from its parent query.
@@ -411,18 +839,11 @@ class OrderBy:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.order_by == self:
-                self._parent.order_by = None
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class GroupBy:
     """
     Represents a GROUP BY clause in a SPARQL query.
@@ -433,7 +854,10 @@ class GroupBy:
         The variables to group by.
     """
     variables: List[str]
-    _parent = None  # Reference to parent query
+
+    def __post_init__(self):
+        self._parent = None  # Reference to parent query
+        self.variables = [_intern(variable) for variable in self.variables]
     
     def add(self, variable):
         """
@@ -450,9 +874,13 @@ class GroupBy:
             For method chaining
         """
         if variable not in self.variables:
-            self.variables.append(variable)
+            self.variables.append(_intern(variable))
         return self
     
+    def _clone(self) -> 'GroupBy':
+        """Return a copy of this GROUP BY clause without a parent."""
+        return GroupBy(self.variables)  # __post_init__ copies the list
+
     def remove(self):
         """
         Remove this GROUP BY clause from its parent query.
@@ -462,18 +890,11 @@ class GroupBy:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.group_by == self:
-                self._parent.group_by = None
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class SubQuery:
     """
     Represents a subquery in a SPARQL query.
@@ -484,9 +905,9 @@ class SubQuery:
         The subquery.
     """
     query: 'SPARQLQuery'
-    _parent = None  # Reference to parent container
-    
+
     def __post_init__(self):
+        self._parent = None  # Reference to parent container
         self.query._parent = self
     
     def add(self, component):
@@ -504,6 +925,16 @@ class SubQuery:
         """
         return self.query.add(component)
         
+    def _clone(self) -> 'SubQuery':
+        """Return a copy of this subquery and its query, without a parent."""
+        clone = SubQuery.__new__(SubQuery)
+        clone.query = None
+        clone._parent = None
+        if self.query is not None:
+            clone.query = self.query._clone()
+            clone.query._parent = clone
+        return clone
+
     def remove(self):
         """
         Remove this subquery from its parent container.
@@ -513,40 +944,28 @@ class SubQuery:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
+        return self._parent is not None and self._parent._detach_child(self)
+
+    def canonical_key(self) -> bytes:
+        """
+        Return a cache key for the wrapped query.
+
+        See ``SPARQLQuery.canonical_key``.
+        """
+        return self.query.canonical_key()
+
+    def _detach_child(self, child) -> bool:
+        """Detach the wrapped query; the now empty subquery is removed as well."""
+        if child is not self.query:
             return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.where_clause == self:
-                self._parent.where_clause = None
-                return True
-            elif isinstance(self._parent.where_clause, list) and self in self._parent.where_clause:
-                self._parent.where_clause.remove(self)
-                return True
-        elif isinstance(self._parent, OptionalOperator):
-            if self._parent.bgp == self:
-                self._parent.bgp = None
-                self._parent.remove()  # Remove the optional operator as it's no longer valid
-                return True
-        elif isinstance(self._parent, UnionOperator):
-            if self._parent.left == self:
-                self._parent.left = None
-                self._parent.remove()  # Remove the union as it's no longer valid
-                return True
-            elif self._parent.right == self:
-                self._parent.right = None
-                self._parent.remove()  # Remove the union as it's no longer valid
-                return True
-        elif isinstance(self._parent, GroupGraphPattern):
-            if self._parent.pattern == self:
-                self._parent.pattern = None
-                self._parent.remove()  # Remove the group as it's no longer valid
-                return True
-                
-        return False
+        _shift_triple_count(self, -child.n_triple_patterns)
+        self.query = None
+        self.remove()  # Remove the subquery as it's no longer valid
+        return True
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class GroupGraphPattern:
     """
     Represents a nested group graph pattern in a SPARQL query.
@@ -560,9 +979,9 @@ class GroupGraphPattern:
     """
     pattern: Union['BGP', 'UnionOperator', 'OptionalOperator', 'SubQuery', 'GroupGraphPattern']
     filters: List['Filter'] = field(default_factory=list)
-    _parent = None  # Reference to parent container
-    
+
     def __post_init__(self):
+        self._parent = None  # Reference to parent container
         # Set parent references
         if hasattr(self.pattern, '_parent'):
             self.pattern._parent = self
@@ -587,30 +1006,36 @@ class GroupGraphPattern:
         TypeError
             If the component is not a valid type or if trying to add a pattern when one already exists
         """
-        # Handle filter case
-        if isinstance(component, Filter):
-            component._parent = self
-            self.filters.append(component)
-            return component
-            
+        component_type = type(component)
+
         # Handle filter expression string
-        elif isinstance(component, str):
+        if component_type is str or isinstance(component, str):
             filter = Filter(expression=component)
             filter._parent = self
             self.filters.append(filter)
             return filter
-            
+
+        # Handle filter case
+        elif isinstance(component, Filter):
+            component._parent = self
+            self.filters.append(component)
+            return component
+
         # Handle pattern case
-        elif isinstance(component, (BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern)):
+        elif component_type in _PATTERN_TYPE_SET or isinstance(component, _PATTERN_TYPES):
             if self.pattern is not None:
                 raise TypeError("GroupGraphPattern already has a pattern. Cannot add another one.")
             self.pattern = component
-            component._parent = self
+            _shift_triple_count(self, _walk_where(component, self))
             return component
             
         else:
             raise TypeError(f"Cannot add component of type {type(component)} to GroupGraphPattern")
             
+    def _clone(self) -> 'GroupGraphPattern':
+        """Return a copy of this group, its pattern and its filters, without a parent."""
+        return _clone_clause(self)
+
     def remove(self):
         """
         Remove this group graph pattern from its parent container.
@@ -620,25 +1045,20 @@ class GroupGraphPattern:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self._parent.where_clause == self:
-                self._parent.where_clause = None
-                return True
-            elif isinstance(self._parent.where_clause, list) and self in self._parent.where_clause:
-                self._parent.where_clause.remove(self)
-                return True
-        elif isinstance(self._parent, GroupGraphPattern):
-            if self._parent.pattern == self:
-                self._parent.pattern = None
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
+
+    def _detach_child(self, child) -> bool:
+        """Detach a filter or the contained pattern; an empty group is removed as well."""
+        if child is self.pattern:
+            _shift_triple_count(self, -_walk_where(child))
+            self.pattern = None
+            self.remove()  # Remove the group as it's no longer valid
+            return True
+        return _remove_identical(self.filters, child)
 
 
-@dataclass
+@_slotted
+@dataclass(eq=False)
 class AggregationExpression:
     """
     Represents an aggregation expression in a SPARQL query SELECT clause.
@@ -658,8 +1078,14 @@ class AggregationExpression:
     variable: str  # Variable or expression to aggregate
     alias: str     # Result variable name (after AS)
     distinct: bool = False
-    _parent = None  # Reference to parent query
+
+    def __post_init__(self):
+        self._parent = None  # Reference to parent query
     
+    def _clone(self) -> 'AggregationExpression':
+        """Return a copy of this aggregation expression without a parent."""
+        return AggregationExpression(self.function, self.variable, self.alias, self.distinct)
+
     def remove(self):
         """
         Remove this aggregation expression from its parent query.
@@ -669,15 +1095,226 @@ class AggregationExpression:
         bool
             True if removal was successful, False otherwise.
         """
-        if self._parent is None:
-            return False
-            
-        if isinstance(self._parent, SPARQLQuery):
-            if self in self._parent.aggregations:
-                self._parent.aggregations.remove(self)
-                return True
-                
-        return False
+        return self._parent is not None and self._parent._detach_child(self)
+
+
+@_slotted(parent=False)
+@dataclass(eq=False)
+class QueryStatistics:
+    """
+    Cardinality estimates a planner can attach to a query with ``SPARQLQuery.stats_hint``.
+
+    Attributes
+    ----------
+    triple_card : Dict[Tuple[str, str, str], float]
+        Estimated cardinality per triple pattern, keyed by its (subject, predicate,
+        object), so that the estimates also apply to copies of the query.
+    predicate_card : Dict[str, int]
+        Number of triples per predicate.
+    """
+    triple_card: Dict[Tuple[str, str, str], float] = field(default_factory=dict)
+    predicate_card: Dict[str, int] = field(default_factory=dict)
+
+    def cardinality(self, triple: TriplePattern) -> Optional[float]:
+        """Return the estimated cardinality of ``triple``, or None if unknown."""
+        cardinality = self.triple_card.get(_triple_terms(triple))
+        if cardinality is None:
+            cardinality = self.predicate_card.get(triple.predicate)
+        return cardinality
+
+
+def _clone_clause(clause, parent=None):
+    """
+    Copy a where clause, or part of it, as ``copy.deepcopy`` would but without the memo.
+
+    The tree is copied iteratively: operators are first copied without their nested
+    clauses, which are then filled in from an explicit stack. Parent references are
+    set throughout the copy, with ``parent`` as the parent of its top-level components.
+    """
+    holder = [clause]
+    # (container, key, owner): container[key] (or its attribute key) still refers to
+    # the original clause; owner is the node to set as parent of its copy
+    stack = [(holder, 0, parent)]
+    while stack:
+        container, key, owner = stack.pop()
+        node = container[key] if type(container) is list else getattr(container, key)
+        if type(node) is list:
+            copy = list(node)
+            stack.extend((copy, index, owner) for index in range(len(copy)))
+        elif node is None:
+            continue
+        else:
+            attrs = _lookup_by_type(_NESTED_CLAUSE_ATTRS, node)
+            if attrs is None:
+                copy = node._clone()  # BGPs and subqueries
+            else:
+                copy = object.__new__(type(node))
+                for attr in attrs:
+                    setattr(copy, attr, getattr(node, attr))
+                    stack.append((copy, attr, copy))
+                if isinstance(node, GroupGraphPattern):
+                    copy.filters = [filter._clone() for filter in node.filters]
+                    for filter in copy.filters:
+                        filter._parent = copy
+            copy._parent = owner
+        if type(container) is list:
+            container[key] = copy
+        else:
+            setattr(container, key, copy)
+    return holder[0]
+
+
+def _enclosing_statistics(node) -> Optional[QueryStatistics]:
+    """Return the statistics of the nearest enclosing query that has them."""
+    while node is not None:
+        if isinstance(node, SPARQLQuery) and node.statistics is not None:
+            return node.statistics
+        node = node._parent
+    return None
+
+
+def _walk_bgp(bgp: BGP, stack: list) -> int:
+    for triple in bgp.triples:
+        triple._parent = bgp
+    for filter in bgp.filters:
+        filter._parent = bgp
+    return len(bgp.triples)
+
+
+def _walk_union(union: UnionOperator, stack: list) -> int:
+    stack.append((union.left, union))
+    stack.append((union.right, union))
+    return 0
+
+
+def _walk_optional(optional: OptionalOperator, stack: list) -> int:
+    stack.append((optional.bgp, optional))
+    return 0
+
+
+def _walk_subquery(subquery: SubQuery, stack: list) -> int:
+    if subquery.query is None:
+        return 0
+    subquery.query._parent = subquery
+    return subquery.query.n_triple_patterns
+
+
+def _walk_group(group: GroupGraphPattern, stack: list) -> int:
+    for filter in group.filters:
+        filter._parent = group
+    stack.append((group.pattern, group))
+    return 0
+
+
+# Per-type steps of _walk_where: each wires up the node's children,
+# pushes nested patterns onto the stack and returns the node's own triple count
+_WHERE_WALKERS = {
+    BGP: _walk_bgp,
+    UnionOperator: _walk_union,
+    OptionalOperator: _walk_optional,
+    SubQuery: _walk_subquery,
+    GroupGraphPattern: _walk_group,
+}
+
+# Components that may appear in a where clause. ``add`` checks membership of the exact
+# type in the frozenset and only falls back to isinstance for subclasses.
+_PATTERN_TYPES = tuple(_WHERE_WALKERS)
+_PATTERN_TYPE_SET = frozenset(_PATTERN_TYPES)
+
+
+def _lookup_by_type(table: dict, node):
+    """
+    Look up the entry for the type of ``node`` in a type-keyed dispatch table.
+
+    The component classes are not subclassed in this package, so this is usually a
+    single dict probe; instances of subclasses fall back to their nearest
+    registered base class. Returns None if no entry applies.
+    """
+    entry = table.get(type(node))
+    if entry is None:
+        for base in type(node).__mro__[1:]:
+            entry = table.get(base)
+            if entry is not None:
+                break
+    return entry
+
+
+# Attributes holding the nested patterns of each operator, in document order
+_NESTED_CLAUSE_ATTRS = {
+    UnionOperator: ('left', 'right'),
+    OptionalOperator: ('bgp',),
+    GroupGraphPattern: ('pattern',),
+}
+
+
+def _iter_clauses(clause, into_subqueries: bool = False):
+    """
+    Yield the components of a where clause in document order, without recursion.
+
+    Lists are flattened and not yielded themselves. SubQuery components are
+    yielded; their where clauses are only entered if ``into_subqueries`` is set.
+    """
+    stack = [clause]
+    while stack:
+        node = stack.pop()
+        if type(node) is list:
+            stack.extend(reversed(node))
+            continue
+        if node is None:
+            continue
+        yield node
+        if isinstance(node, SubQuery):
+            if into_subqueries and node.query is not None:
+                stack.append(node.query.where_clause)
+            continue
+        attrs = _lookup_by_type(_NESTED_CLAUSE_ATTRS, node)
+        if attrs is not None:
+            for attr in reversed(attrs):
+                stack.append(getattr(node, attr))
+
+
+def _walk_where(clause, parent=None) -> int:
+    """
+    Set parent references throughout a where clause and count its triple patterns.
+
+    The clause is traversed once, iteratively, with an explicit stack of
+    ``(node, parent)`` pairs and a walker looked up by node type.
+
+    Parameters
+    ----------
+    clause : Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List]
+        The where clause (or part of it) to walk.
+    parent : object, optional
+        The container to set as parent of the top-level components. If None,
+        their parent references are left untouched.
+
+    Returns
+    -------
+    int
+        The number of triple patterns in the clause.
+    """
+    count = 0
+    stack = [(clause, parent)]
+    while stack:
+        node, node_parent = stack.pop()
+        walker = _lookup_by_type(_WHERE_WALKERS, node)
+        if walker is not None:
+            if node_parent is not None:
+                node._parent = node_parent
+            count += walker(node, stack)
+        elif isinstance(node, list):
+            stack.extend((item, node_parent) for item in node)
+    return count
+
+
+def _shift_triple_count(node, delta: int):
+    """
+    Add ``delta`` to the triple pattern count of every query enclosing ``node``.
+    """
+    while node is not None:
+        if isinstance(node, SPARQLQuery):
+            node.n_triple_patterns += delta
+        node = node._parent
 
 
 class SPARQLQuery:
@@ -713,8 +1350,16 @@ class SPARQLQuery:
         Namespace prefixes used in the query.
     n_triple_patterns : int
         Count of triple patterns in the query.
+    statistics : Optional[QueryStatistics]
+        Cardinality estimates set with ``stats_hint``, used by ``BGP.reorder_by_selectivity``.
     
     """
+    __slots__ = (
+        '_projection_variables', 'where_clause', 'filters', 'having', 'order_by', 'group_by',
+        'limit', 'offset', 'graph', 'is_distinct', 'aggregations', 'prefixes',
+        'n_triple_patterns', 'statistics', '_parent',
+    )
+
     def __init__(
             self,
             projection_variables: List[str] = None,
@@ -733,8 +1378,8 @@ class SPARQLQuery:
 
         self._projection_variables = None  # Use property for validation
         self.where_clause = where_clause
-        # Set parent reference for each component in where_clause
-        self._set_parent_references(where_clause)
+        # Set parent references in the where clause and count its triple patterns in one pass
+        n_triple_patterns = _walk_where(where_clause, self)
         
         self.filters = filters
         # Set parent reference for each filter
@@ -772,7 +1417,8 @@ class SPARQLQuery:
         # which will trigger validation
         self.projection_variables = projection_variables if projection_variables is not None else ['*']
             
-        self.n_triple_patterns = self._count_triple_patterns(where_clause)
+        self.n_triple_patterns = n_triple_patterns
+        self.statistics = None
         self._parent = None  # Reference to parent (for subqueries)
         
         # Validate prefixes automatically during initialization if a where_clause is provided
@@ -799,6 +1445,10 @@ class SPARQLQuery:
         ValueError
             If non-aggregated variables in SELECT aren't in GROUP BY when GROUP BY is used
         """
+        # Intern in place, so the caller's list stays the stored list
+        if isinstance(variables, list):
+            for i, variable in enumerate(variables):
+                variables[i] = _intern(variable)
         # Store variables
         self._projection_variables = variables
         
@@ -811,37 +1461,28 @@ class SPARQLQuery:
             # Build a set of aggregation result variables (the aliases)
             agg_result_vars = {agg.alias for agg in self.aggregations}
             
+            group_vars = set(self.group_by.variables)
+            
             # Check each projection variable that isn't an aggregation result
             for var in variables:
-                if var not in agg_result_vars and var not in self.group_by.variables:
+                if var not in agg_result_vars and var not in group_vars:
                     raise ValueError(f"Non-aggregated SELECT variable '{var}' must be in GROUP BY")
 
-    def _set_parent_references(self, clause):
-        """Set parent references for components in the where clause."""
-        if isinstance(clause, (BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern)):
-            clause._parent = self
-            
-            # Recursively set parent references for nested components
-            if isinstance(clause, BGP):
-                for triple in clause.triples:
-                    triple._parent = clause
-                for filter in clause.filters:
-                    filter._parent = clause
-            elif isinstance(clause, UnionOperator):
-                self._set_parent_references(clause.left)
-                self._set_parent_references(clause.right)
-            elif isinstance(clause, OptionalOperator):
-                self._set_parent_references(clause.bgp)
-            elif isinstance(clause, SubQuery):
-                clause.query._parent = clause
-            elif isinstance(clause, GroupGraphPattern):
-                self._set_parent_references(clause.pattern)
-                for filter in clause.filters:
-                    filter._parent = clause
-        elif isinstance(clause, list):
-            for item in clause:
-                self._set_parent_references(item)
-    
+    @property
+    def where_clauses(self) -> List[Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern]]:
+        """
+        The top-level components of the WHERE clause as a list.
+
+        ``where_clause`` holds either a single component or a list of them; this
+        gives uniform read access. If ``where_clause`` is a list, it is returned itself.
+        """
+        where_clause = self.where_clause
+        if where_clause is None:
+            return []
+        if type(where_clause) is list:
+            return where_clause
+        return [where_clause]
+
     def add(self, component):
         """
         Add a component to the query's WHERE clause.
@@ -860,25 +1501,27 @@ class SPARQLQuery:
         TypeError
             If the component is not a valid type
         """
-        # Handle filter case
-        if isinstance(component, Filter):
-            if self.filters is None:
-                self.filters = []
-            component._parent = self
-            self.filters.append(component)
-            return component
-            
+        component_type = type(component)
+
         # Handle filter expression string
-        elif isinstance(component, str) and not isinstance(component, (BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern)):
+        if component_type is str or isinstance(component, str):
             filter = Filter(expression=component)
             if self.filters is None:
                 self.filters = []
             filter._parent = self
             self.filters.append(filter)
             return filter
-            
-        # Handle other components for where_clause
-        elif isinstance(component, (BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern)):
+
+        # Handle filter case
+        elif isinstance(component, Filter):
+            if self.filters is None:
+                self.filters = []
+            component._parent = self
+            self.filters.append(component)
+            return component
+
+        # Handle components for where_clause
+        elif component_type in _PATTERN_TYPE_SET or isinstance(component, _PATTERN_TYPES):
             if self.where_clause is None:
                 self.where_clause = component
                 component._parent = self
@@ -890,13 +1533,49 @@ class SPARQLQuery:
                 self.where_clause = [self.where_clause, component]
                 component._parent = self
                 
-            # Update triple pattern count
-            self.n_triple_patterns = self._count_triple_patterns(self.where_clause)
+            # Update triple pattern counts by the size of the added component only
+            _shift_triple_count(self, _walk_where(component, self))
             return component
             
         else:
             raise TypeError(f"Cannot add component of type {type(component)} to SPARQLQuery")
     
+    def _detach_child(self, child) -> bool:
+        """
+        Detach a component from this query.
+
+        Called by the ``remove()`` methods of the query components, which only
+        need to know their parent and not the parent's type.
+
+        Parameters
+        ----------
+        child : object
+            The component to detach.
+
+        Returns
+        -------
+        bool
+            True if the component was found (by identity) and detached, False otherwise.
+        """
+        if child is self.where_clause:
+            _shift_triple_count(self, -_walk_where(child))
+            self.where_clause = None
+            return True
+        if isinstance(self.where_clause, list) and _remove_identical(self.where_clause, child):
+            _shift_triple_count(self, -_walk_where(child))
+            return True
+        if child is self.order_by:
+            self.order_by = None
+            return True
+        if child is self.group_by:
+            self.group_by = None
+            return True
+        return (
+            _remove_identical(self.filters, child) or
+            _remove_identical(self.having, child) or
+            _remove_identical(self.aggregations, child)
+        )
+
     def add_having(self, expression):
         """
         Add a HAVING condition to the query.
@@ -988,27 +1667,26 @@ class SPARQLQuery:
             if isinstance(aggregations, AggregationExpression):
                 aggregations = [aggregations]
             
-            # Validate each aggregation variable isn't in GROUP BY
+            # Validate each aggregation variable isn't in GROUP BY, comparing names
+            # without the '?' prefix
+            group_var_names = {var[1:] if var.startswith('?') else var for var in variables}
             for agg in aggregations:
                 if agg.variable != '*':
-                    # Remove '?' prefix for comparison if present
                     agg_var = agg.variable[1:] if agg.variable.startswith('?') else agg.variable
-                    
-                    # Check if any GROUP BY variable matches
-                    for var in variables:
-                        var_name = var[1:] if var.startswith('?') else var
-                        if agg_var == var_name:
-                            raise ValueError(f"Aggregation variable '{agg.variable}' cannot be in GROUP BY")
+                    if agg_var in group_var_names:
+                        raise ValueError(f"Aggregation variable '{agg.variable}' cannot be in GROUP BY")
         
         # Set up GROUP BY
         if self.group_by is None:
             self.group_by = GroupBy(variables=variables)
             self.group_by._parent = self
         else:
+            known = set(self.group_by.variables)
             for var in variables:
                 # Skip duplicates
-                if var not in self.group_by.variables:
-                    self.group_by.variables.append(var)
+                if var not in known:
+                    known.add(var)
+                    self.group_by.variables.append(_intern(var))
         
         # Add aggregations if provided
         if aggregations:
@@ -1021,10 +1699,11 @@ class SPARQLQuery:
         if self.projection_variables != ['*']:
             # Build a set of aggregation result variables (the aliases)
             agg_result_vars = {agg.alias for agg in self.aggregations}
+            group_vars = set(self.group_by.variables)
             
             # Check each projection variable that isn't an aggregation result
             for var in self.projection_variables:
-                if var not in agg_result_vars and var not in self.group_by.variables:
+                if var not in agg_result_vars and var not in group_vars:
                     raise ValueError(f"Non-aggregated SELECT variable '{var}' must be in GROUP BY")
                 
         return self
@@ -1060,6 +1739,26 @@ class SPARQLQuery:
                     
         return self.order_by
     
+    def stats_hint(self, stats: QueryStatistics) -> 'SPARQLQuery':
+        """
+        Attach cardinality estimates to the query.
+
+        The statistics are kept for later optimization passes; ``BGP.reorder_by_selectivity``
+        uses them for every BGP nested in this query unless given statistics explicitly.
+
+        Parameters
+        ----------
+        stats : QueryStatistics
+            The statistics to attach, or None to remove them.
+
+        Returns
+        -------
+        SPARQLQuery
+            self, for method chaining.
+        """
+        self.statistics = stats
+        return self
+
     def set_limit(self, limit):
         """
         Set the LIMIT value for the query.
@@ -1128,22 +1827,35 @@ class SPARQLQuery:
         SPARQLQuery
             The query with instantiated variables and adjusted projection variables.
         """
-        self._instantiate_clause(self.where_clause, mapping_dict)
+        return self._instantiate(self._resolve_mapping(mapping_dict, self.get_all_variables()))
+
+    def _instantiate(self, replacements: Dict[str, str]) -> 'SPARQLQuery':
+        """Apply a mapping prepared by ``_resolve_mapping`` to this query."""
+        triples, filters, subqueries = self._flatten_where_clause()
+        for triple in triples:
+            if triple._parent is not None:
+                triple._parent._triple_index = None  # Terms change, see BGP.reindex
+            triple.subject = replacements.get(triple.subject, triple.subject)
+            triple.predicate = replacements.get(triple.predicate, triple.predicate)
+            triple.object = replacements.get(triple.object, triple.object)
+        if self.filters:
+            filters.extend(self.filters)
+        if filters:
+            def substitute(match):
+                # Only variables are replaced, not text inside IRIs or string literals
+                if match.group(1) is None:
+                    return match.group(0)
+                return replacements.get('?' + match.group(1), match.group(0))
+
+            for filter in filters:
+                filter.expression = _CANONICAL_TOKEN.sub(substitute, filter.expression)
+        for subquery in subqueries:
+            subquery.query._instantiate(replacements)
 
         # After instantiation, remove instantiated variables from projection variables
         if self.projection_variables != ['*']:
             # Keep only variables that were not instantiated
-            # Check both forms: with and without '?' prefix
-            filtered_vars = []
-            for var in self.projection_variables:
-                if var.startswith('?'):
-                    var_name = var[1:]
-                    if var_name not in mapping_dict and var not in mapping_dict:
-                        filtered_vars.append(var)
-                else:
-                    filtered_vars.append(var)
-            
-            self.projection_variables = filtered_vars
+            self.projection_variables = [var for var in self.projection_variables if var not in replacements]
             
             # If all projection variables were instantiated, get all remaining variables
             if not self.projection_variables:
@@ -1153,7 +1865,7 @@ class SPARQLQuery:
 
     def get_all_variables(self) -> Set[str]:
         """
-        Collect all variables in the query's WHERE clause.
+        Collect all variables in the query's WHERE clause, including those used in filters.
 
         Returns
         -------
@@ -1162,84 +1874,83 @@ class SPARQLQuery:
         """
         variables = set()
         self._collect_variables(self.where_clause, variables)
+        for filter in self.filters or ():
+            variables.update(_expression_variables(filter.expression))
         return variables
 
     def _collect_variables(
             self,
-            clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, List[SubQuery]],
+            clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List],
             variables: Set[str]
     ):
-        if isinstance(clause, BGP):
-            for triple in clause.triples:
-                for term in [triple.subject, triple.predicate, triple.object]:
-                    if term.startswith('?'):
-                        variables.add(term)
-        elif isinstance(clause, UnionOperator):
-            self._collect_variables(clause.left, variables)
-            self._collect_variables(clause.right, variables)
-        elif isinstance(clause, OptionalOperator):
-            self._collect_variables(clause.bgp, variables)
-        elif isinstance(clause, SubQuery):
-            variables.update(clause.query.get_all_variables())
-        elif isinstance(clause, list):
-            for subquery in clause:
-                self._collect_variables(subquery, variables)
-        # Filters might contain variables as well
-        if hasattr(clause, 'expression') and isinstance(clause.expression, str):
-            for word in clause.expression.split():
-                if word.startswith('?'):
-                    variables.add(word)
-
-    def _instantiate_clause(
-            self,
-            clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, List[SubQuery]],
-            mapping_dict: Dict[str, str]
-    ):
-        if isinstance(clause, BGP):
-            for triple in clause.triples:
-                triple.subject = self._replace_variable(triple.subject, mapping_dict)
-                triple.predicate = self._replace_variable(triple.predicate, mapping_dict)
-                triple.object = self._replace_variable(triple.object, mapping_dict)
-        elif isinstance(clause, UnionOperator):
-            self._instantiate_clause(clause.left, mapping_dict)
-            self._instantiate_clause(clause.right, mapping_dict)
-        elif isinstance(clause, OptionalOperator):
-            self._instantiate_clause(clause.bgp, mapping_dict)
-        elif isinstance(clause, SubQuery):
-            clause.query.instantiate(mapping_dict)
-        elif isinstance(clause, list):
-            for item in clause:
-                self._instantiate_clause(item, mapping_dict)
-
-    def _replace_variable(self, value: str, mapping_dict: Dict[str, str]) -> str:
-        if value.startswith('?'):
-            var_name = value[1:]
-            # Check both with and without '?' prefix in the mapping
-            if var_name in mapping_dict:
-                replacement = mapping_dict[var_name]
-                # Don't add angle brackets if the replacement is already a URI or a literal
-                if replacement.startswith('<') and replacement.endswith('>'):
-                    return replacement
-                elif replacement.startswith('"') or replacement.startswith("'"):
-                    return replacement
-                elif replacement.replace('.', '', 1).isdigit():  # Handle numeric literals
-                    return replacement
-                else:
-                    # Default to URI format if not explicitly a literal
-                    return f"<{replacement}>"
-            elif value in mapping_dict:  # Try with the full variable name including '?'
-                replacement = mapping_dict[value]
-                # Don't add angle brackets if the replacement is already a URI or a literal
-                if replacement.startswith('<') and replacement.endswith('>'):
-                    return replacement
-                elif replacement.startswith('"') or replacement.startswith("'"):
-                    return replacement
-                elif replacement.replace('.', '', 1).isdigit():  # Handle numeric literals
-                    return replacement
-                else:
-                    # Default to URI format if not explicitly a literal
-                    return f"<{replacement}>"
-        return value
+        for component in _iter_clauses(clause, into_subqueries=True):
+            if isinstance(component, BGP):
+                # One set.update over the per-triple cached variable sets
+                variables.update(*[triple.vars for triple in component.triples])
+                filters = component.filters
+            elif isinstance(component, GroupGraphPattern):
+                filters = component.filters
+            elif isinstance(component, SubQuery) and component.query is not None:
+                filters = component.query.filters or ()
+            else:
+                continue
+            # Filters might contain variables as well
+            for filter in filters:
+                variables.update(_expression_variables(filter.expression))
+
+    def _flatten_where_clause(self):
+        """
+        Collect the triple patterns of the where clause in a flat list.
+
+        Returns
+        -------
+        Tuple[List[TriplePattern], List[Filter], List[SubQuery]]
+            The triple patterns and the filters of BGPs and groups outside of
+            subqueries, and the subqueries.
+        """
+        triples = []
+        filters = []
+        subqueries = []
+        for component in _iter_clauses(self.where_clause):
+            if isinstance(component, BGP):
+                triples.extend(component.triples)
+                filters.extend(component.filters)
+            elif isinstance(component, GroupGraphPattern):
+                filters.extend(component.filters)
+            elif isinstance(component, SubQuery):
+                subqueries.append(component)
+        return triples, filters, subqueries
+
+    @staticmethod
+    def _resolve_mapping(mapping_dict: Dict[str, str], used_variables: Set[str]) -> Dict[str, str]:
+        """
+        Turn a user supplied variable mapping into a ``'?var' -> term`` lookup table.
+
+        Keys may be given with or without the '?' prefix; if both forms are given, the
+        one without prefix wins. Values of the variables in ``used_variables`` that are
+        not already an IRI in angle brackets, a quoted literal or a number are wrapped
+        in angle brackets. Values of other variables are never substituted and are kept
+        as given; their keys only take the variables out of the projection.
+        """
+        replacements = {}
+        for key, replacement in mapping_dict.items():
+            variable = key if key.startswith('?') else '?' + key
+            if variable not in used_variables:
+                pass
+            elif replacement.startswith('<') and replacement.endswith('>'):
+                pass
+            elif replacement.startswith('"') or replacement.startswith("'"):
+                pass
+            elif replacement.replace('.', '', 1).isdigit():  # Handle numeric literals
+                pass
+            else:
+                # Default to URI format if not explicitly a literal
+                replacement = f"<{replacement}>"
+            if key.startswith('?'):
+                replacements.setdefault(key, replacement)
+            else:
+                replacements['?' + key] = replacement
+        return replacements
 
     def copy(self, **kwargs) -> 'SPARQLQuery':
         """
@@ -1255,7 +1966,7 @@ class SPARQLQuery:
         SPARQLQuery
             A new SPARQLQuery object with the specified attribute overrides.
         """
-        new_query = copy.deepcopy(self)
+        new_query = self._clone()
         for key, value in kwargs.items():
             if hasattr(new_query, key):
                 setattr(new_query, key, value)
@@ -1263,6 +1974,49 @@ class SPARQLQuery:
                 raise AttributeError(f"'SPARQLQuery' object has no attribute '{key}'")
         return new_query
 
+    def _clone(self) -> 'SPARQLQuery':
+        """
+        Return a deep copy of this query without a parent.
+
+        Rebuilds the tree node by node instead of going through ``copy.deepcopy``;
+        strings are immutable and shared. The projection, GROUP BY and prefixes are
+        known to be valid already, so ``__init__`` and its validation are skipped.
+        """
+        clone = SPARQLQuery.__new__(SPARQLQuery)
+        clone.where_clause = _clone_clause(self.where_clause, clone)
+        clone.filters = None
+        if self.filters is not None:
+            clone.filters = [filter._clone() for filter in self.filters]
+            for filter in clone.filters:
+                filter._parent = clone
+        clone.having = None
+        if self.having is not None:
+            clone.having = [having._clone() for having in self.having]
+            for having in clone.having:
+                having._parent = clone
+        clone.order_by = None
+        if self.order_by is not None:
+            clone.order_by = self.order_by._clone()
+            clone.order_by._parent = clone
+        clone.group_by = None
+        if self.group_by is not None:
+            clone.group_by = self.group_by._clone()
+            clone.group_by._parent = clone
+        clone.aggregations = [aggregation._clone() for aggregation in self.aggregations]
+        for aggregation in clone.aggregations:
+            aggregation._parent = clone
+        clone._projection_variables = list(self._projection_variables)
+        clone.limit = self.limit
+        clone.offset = self.offset
+        clone.graph = self.graph
+        clone.is_distinct = self.is_distinct
+        clone.prefixes = dict(self.prefixes)
+        clone.n_triple_patterns = self.n_triple_patterns
+        # Shared; the estimates are keyed by terms, so they apply to the cloned triples as well
+        clone.statistics = self.statistics
+        clone._parent = None
+        return clone
+
     def to_query_string(self) -> str:
         """
         Convert the SPARQLQuery object to a SPARQL query string.
@@ -1272,13 +2026,13 @@ class SPARQLQuery:
         str
             The SPARQL query string.
         """
-        query = ""
+        parts = []
         
         # Add PREFIX declarations if present
         if self.prefixes:
             for prefix, uri in self.prefixes.items():
-                query += f"PREFIX {prefix}: <{uri}>\n"
-            query += "\n"
+                parts.append(f"PREFIX {prefix}: <{uri}>\n")
+            parts.append("\n")
             
         distinct = "DISTINCT " if self.is_distinct else ""
         
@@ -1305,30 +2059,42 @@ class SPARQLQuery:
             else:
                 projection_str = "*"
             
-        query += f"SELECT {distinct}{projection_str}\n"
+        parts.append(f"SELECT {distinct}{projection_str}\n")
         
         if self.graph:
-            query += f"FROM <{self.graph}>\n"
-        query += "WHERE {\n"
-        query += self._serialize_where_clause(self.where_clause, 1)
+            parts.append(f"FROM <{self.graph}>\n")
+        parts.append("WHERE {\n")
+        self._serialize_where_clause(self.where_clause, 1, parts)
         # Only include top-level filters (those not associated with any BGP or GroupGraphPattern)
         if self.filters:
             for filter in self.filters:
-                query += f"  FILTER({filter.expression})\n"
-        query += "}"
+                parts.append(f"  FILTER({filter.expression})\n")
+        parts.append("}")
         
+        # Most generated queries have no solution modifiers; skip the checks for each
+        if self._has_solution_modifiers():
+            self._serialize_solution_modifiers(parts)
+        return "".join(parts)
+
+    def _has_solution_modifiers(self) -> bool:
+        """Whether the query has GROUP BY, HAVING, ORDER BY, LIMIT or OFFSET."""
+        return bool(self.group_by or self.having or self.order_by
+                    or self.limit is not None or self.offset is not None)
+
+    def _serialize_solution_modifiers(self, parts: List[str]):
+        """Append GROUP BY, HAVING, ORDER BY, LIMIT and OFFSET to ``parts``."""
         # Add GROUP BY if present
         if self.group_by and self.group_by.variables:
-            query += f"\nGROUP BY {' '.join(self.group_by.variables)}"
+            parts.append(f"\nGROUP BY {' '.join(self.group_by.variables)}")
         
         # Add HAVING if present
         if self.having:
             for having in self.having:
-                query += f"\nHAVING({having.expression})"
+                parts.append(f"\nHAVING({having.expression})")
         
         # Add ORDER BY if present
         if self.order_by:
-            query += "\nORDER BY "
+            parts.append("\nORDER BY ")
             terms = []
             
             # Handle either a single boolean or a list of booleans
@@ -1347,78 +2113,92 @@ class SPARQLQuery:
                         # Default to ASC if we run out of direction flags
                         terms.append(f"ASC({var})")
             
-            query += " ".join(terms)
+            parts.append(" ".join(terms))
         if self.limit is not None:
-            query += f"\nLIMIT {self.limit}"
+            parts.append(f"\nLIMIT {self.limit}")
         if self.offset is not None:
-            query += f"\nOFFSET {self.offset}"
-        return query
+            parts.append(f"\nOFFSET {self.offset}")
 
     def _serialize_where_clause(
             self,
             clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[
                 Union['BGP', 'UnionOperator', 'OptionalOperator', 'SubQuery', 'GroupGraphPattern']]],
-            indent: int
-    ) -> str:
-        if isinstance(clause, BGP):
-            return self._serialize_bgp(clause, indent)
-        elif isinstance(clause, UnionOperator):
-            return self._serialize_union(clause, indent)
-        elif isinstance(clause, OptionalOperator):
-            return self._serialize_optional(clause, indent)
-        elif isinstance(clause, SubQuery):
-            return self._serialize_subquery(clause, indent)
-        elif isinstance(clause, GroupGraphPattern):
-            return self._serialize_group(clause, indent)
-        elif isinstance(clause, list):
-            return ''.join(self._serialize_where_clause(sq, indent) for sq in clause)
-        else:
-            raise ValueError(f"Unknown clause type: {type(clause)}")
-
-    def _serialize_bgp(self, bgp: BGP, indent: int) -> str:
-        result = ""
+            indent: int,
+            parts: List[str]
+    ):
+        """Append the serialization of ``clause`` at the given indentation level to ``parts``."""
+        # Holds (clause, indent) pairs still to serialize and (text, None) pairs to emit as is
+        stack = [(clause, indent)]
+        while stack:
+            node, level = stack.pop()
+            if level is None:
+                parts.append(node)
+                continue
+            step = _lookup_by_type(_SERIALIZE_STEPS, node)
+            if step is None:
+                raise ValueError(f"Unknown clause type: {type(node)}")
+            step(self, node, level, parts, stack)
+
+    # Steps of _serialize_where_clause, looked up by clause type in _SERIALIZE_STEPS. Each
+    # appends the text of its node to parts and pushes nested clauses and closing text.
+    def _serialize_step_bgp(self, bgp: BGP, level: int, parts: list, stack: list):
+        self._serialize_bgp(bgp, level, parts)
+
+    def _serialize_step_union(self, union: UnionOperator, level: int, parts: list, stack: list):
+        padding = _spaces(2 * level)
+        parts.append(padding + "{\n")
+        stack.append((padding + "}\n", None))
+        stack.append((union.right, level + 1))
+        stack.append((padding + "} UNION {\n", None))
+        stack.append((union.left, level + 1))
+
+    def _serialize_step_optional(self, optional: OptionalOperator, level: int, parts: list, stack: list):
+        padding = _spaces(2 * level)
+        parts.append(padding + "OPTIONAL {\n")
+        stack.append((padding + "}\n", None))
+        stack.append((optional.bgp, level + 1))
+
+    def _serialize_step_subquery(self, subquery: SubQuery, level: int, parts: list, stack: list):
+        self._serialize_subquery(subquery, level, parts)
+
+    def _serialize_step_group(self, group: GroupGraphPattern, level: int, parts: list, stack: list):
+        padding = _spaces(2 * level)
+        parts.append(padding + "{\n")
+        # Filters associated with the group follow its pattern
+        stack.append((padding + "}\n", None))
+        stack.append((''.join(f"{padding}  FILTER({filter.expression})\n" for filter in group.filters), None))
+        stack.append((group.pattern, level + 1))
+
+    def _serialize_step_list(self, clauses: list, level: int, parts: list, stack: list):
+        stack.extend((clause, level) for clause in reversed(clauses))
+
+    def _serialize_bgp(self, bgp: BGP, indent: int, parts: List[str]):
+        padding = _spaces(2 * indent)
         for triple in bgp.triples:
-            result += "  " * indent + f"{triple.subject} {triple.predicate} {triple.object} .\n"
+            parts.append(f"{padding}{triple.subject} {triple.predicate} {triple.object} .\n")
         # Add any filters associated with this BGP
         for filter in bgp.filters:
-            result += "  " * indent + f"FILTER({filter.expression})\n"
-        return result
-
-    def _serialize_union(self, union: UnionOperator, indent: int) -> str:
-        return (
-                "  " * indent + "{\n" +
-                self._serialize_where_clause(union.left, indent + 1) +
-                "  " * indent + "} UNION {\n" +
-                self._serialize_where_clause(union.right, indent + 1) +
-                "  " * indent + "}\n"
-        )
-
-    def _serialize_optional(self, optional: OptionalOperator, indent: int) -> str:
-        return (
-                "  " * indent + "OPTIONAL {\n" +
-                self._serialize_where_clause(optional.bgp, indent + 1) +
-                "  " * indent + "}\n"
-        )
+            parts.append(f"{padding}FILTER({filter.expression})\n")
 
-    def _serialize_subquery(self, subquery: SubQuery, indent: int) -> str:
+    def _serialize_subquery(self, subquery: SubQuery, indent: int, parts: List[str]):
+        padding = _spaces(2 * indent)
         subquery_str = subquery.query.to_query_string()
-        indented_subquery = '\n'.join("  " * indent + line for line in subquery_str.split('\n'))
-        return f"{'  ' * indent}{{\n{indented_subquery}\n{'  ' * indent}}}\n"
-
-    def _serialize_group(self, group: GroupGraphPattern, indent: int) -> str:
-        result = "  " * indent + "{\n"
-        result += self._serialize_where_clause(group.pattern, indent + 1)
-        # Add any filters associated with this group
-        for filter in group.filters:
-            result += "  " * (indent + 1) + f"FILTER({filter.expression})\n"
-        result += "  " * indent + "}\n"
-        return result
+        parts.append(f"{padding}{{\n")
+        parts.append('\n'.join(padding + line for line in subquery_str.split('\n')))
+        parts.append(f"\n{padding}}}\n")
 
     def replace_triple_patterns_with_subqueries(self, limit: int = 300) -> 'SPARQLQuery':
-        new_query = copy.deepcopy(self)
-        new_query.where_clause = self._replace_clause(new_query.where_clause, limit)
+        new_query = self._clone()
+        new_query._replace_triple_patterns(limit)
         return new_query
 
+    def _replace_triple_patterns(self, limit: int):
+        # Rewrites this query in place, including nested subqueries; only called on
+        # a fresh clone, so nothing is copied a second time
+        self.where_clause = self._replace_clause(self.where_clause, limit)
+        # Wire up the generated subqueries; the number of triple patterns is unchanged
+        _walk_where(self.where_clause, self)
+
     def _replace_clause(
             self,
             clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[SubQuery]],
@@ -1426,62 +2206,45 @@ class SPARQLQuery:
     ) -> Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[SubQuery]]:
         if isinstance(clause, BGP):
             return self._replace_bgp(clause, limit)
-        elif isinstance(clause, UnionOperator):
-            clause.left = self._replace_clause(clause.left, limit)
-            clause.right = self._replace_clause(clause.right, limit)
-            return clause
-        elif isinstance(clause, OptionalOperator):
-            clause.bgp = self._replace_clause(clause.bgp, limit)
-            return clause
-        elif isinstance(clause, SubQuery):
-            clause.query = clause.query.replace_triple_patterns_with_subqueries(limit)
-            return clause
-        elif isinstance(clause, GroupGraphPattern):
-            clause.pattern = self._replace_clause(clause.pattern, limit)
-            return clause
-        elif isinstance(clause, list):
-            return [self._replace_clause(sq, limit) for sq in clause]
-        else:
-            raise ValueError(f"Unknown clause type: {type(clause)}")
+
+        # Operators are updated in place; each BGP is swapped for a list of subqueries
+        stack = [clause]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, SubQuery):
+                node.query._replace_triple_patterns(limit)
+            elif isinstance(node, list):
+                for i, child in enumerate(node):
+                    if isinstance(child, BGP):
+                        node[i] = self._replace_bgp(child, limit)
+                    else:
+                        stack.append(child)
+            else:
+                attrs = _lookup_by_type(_NESTED_CLAUSE_ATTRS, node)
+                if attrs is None:
+                    raise ValueError(f"Unknown clause type: {type(node)}")
+                for attr in attrs:
+                    child = getattr(node, attr)
+                    if isinstance(child, BGP):
+                        setattr(node, attr, self._replace_bgp(child, limit))
+                    else:
+                        stack.append(child)
+        return clause
 
     def _replace_bgp(self, bgp: BGP, limit: int) -> Union[BGP, List[SubQuery]]:
         if not bgp.triples:
             return bgp
 
-        subqueries = []
-        for triple in bgp.triples:
-            subquery = SPARQLQuery(
-                projection_variables=["*"],
-                where_clause=BGP([triple]),
-                limit=limit
-            )
-            subqueries.append(SubQuery(subquery))
-
-        return subqueries
-
-    def _count_triple_patterns(
-            self,
-            clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[SubQuery]]
-    ) -> int:
-        if isinstance(clause, BGP):
-            return len(clause.triples)
-        elif isinstance(clause, UnionOperator):
-            return self._count_triple_patterns(clause.left) + self._count_triple_patterns(clause.right)
-        elif isinstance(clause, OptionalOperator):
-            return self._count_triple_patterns(clause.bgp)
-        elif isinstance(clause, SubQuery):
-            return clause.query.n_triple_patterns
-        elif isinstance(clause, GroupGraphPattern):
-            return self._count_triple_patterns(clause.pattern)
-        elif isinstance(clause, list):
-            return sum(self._count_triple_patterns(sq) for sq in clause)
-        else:
-            return 0
+        # The projection defaults to SELECT *
+        return [SubQuery(SPARQLQuery(where_clause=BGP([triple]), limit=limit)) for triple in bgp.triples]
 
     def count_bgps(self) -> int:
         """
         Count the number of Basic Graph Patterns (BGPs) in the query.
 
+        Not cached, as the where clause can be assigned or changed without
+        notifying the query.
+
         Returns
         -------
         int
@@ -1493,20 +2256,98 @@ class SPARQLQuery:
             self,
             clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[SubQuery]]
     ) -> int:
-        if isinstance(clause, BGP):
-            return 1
-        elif isinstance(clause, UnionOperator):
-            return self._count_bgps_recursive(clause.left) + self._count_bgps_recursive(clause.right)
-        elif isinstance(clause, OptionalOperator):
-            return self._count_bgps_recursive(clause.bgp)
-        elif isinstance(clause, SubQuery):
-            return clause.query.count_bgps()
-        elif isinstance(clause, GroupGraphPattern):
-            return self._count_bgps_recursive(clause.pattern)
-        elif isinstance(clause, list):
-            return sum(self._count_bgps_recursive(subquery) for subquery in clause)
-        else:
-            return 0
+        count = 0
+        for component in _iter_clauses(clause):
+            if isinstance(component, BGP):
+                count += 1
+            elif isinstance(component, SubQuery) and component.query is not None:
+                count += component.query.count_bgps()
+        return count
+
+    def canonical_key(self) -> bytes:
+        """
+        Return a stable, hashable key identifying the query up to variable renaming.
+
+        Triple patterns within a BGP and filters within a group are sorted by their
+        variable-blind form, ties broken by the colors color refinement gives their
+        variables, after which variables are renamed to ``?v0, ?v1, ...`` in
+        first-seen order. Structurally identical queries therefore share a key, which
+        makes it suitable for caching evaluation results, e.g. with
+        ``functools.lru_cache`` on an evaluator taking the key.
+
+        The key is not a full canonical form: where color refinement cannot tell
+        variables apart (e.g. in regular structures such as cycles) and their
+        triples tie, the key can still depend on the order of those triples, so
+        isomorphic queries may get different keys. Equal keys always mean
+        equivalent queries.
+
+        Returns
+        -------
+        bytes
+            The SHA-1 digest of the canonical form of the query.
+        """
+        colors, _ = _refine_variable_colors(extract_triple_patterns(self), [])
+
+        def sort_key(text):
+            # Variable-blind form, then the colors of the variables in order of occurrence
+            blind = _CANONICAL_TOKEN.sub(lambda m: '?' if m.group(1) else m.group(0), text)
+            return blind, tuple(colors.get(name, -1) for name in _CANONICAL_TOKEN.findall(text) if name)
+
+        names = {}
+
+        def rename(match):
+            if match.group(1) is None:
+                return match.group(0)
+            return names.setdefault(match.group(1), f"?v{len(names)}")
+
+        canonical = _CANONICAL_TOKEN.sub(rename, self._canonical_text(sort_key))
+        return hashlib.sha1(canonical.encode('utf-8')).digest()
+
+    def _canonical_text(self, sort_key) -> str:
+        parts = [self._canonical_clause(self.where_clause, sort_key)]
+        parts.extend(sorted((f"FILTER({f.expression})" for f in self.filters or []), key=sort_key))
+        parts.append(f"SELECT {'DISTINCT ' if self.is_distinct else ''}{' '.join(self.projection_variables)}")
+        for agg in self.aggregations:
+            parts.append(f"AGG {agg.function}({'DISTINCT ' if agg.distinct else ''}{agg.variable}) AS {agg.alias}")
+        if self.group_by:
+            parts.append(f"GROUP BY {' '.join(self.group_by.variables)}")
+        parts.extend(sorted((f"HAVING({h.expression})" for h in self.having or []), key=sort_key))
+        if self.order_by:
+            parts.append(f"ORDER BY {' '.join(self.order_by.variables)} {self.order_by.ascending}")
+        parts.append(f"LIMIT {self.limit} OFFSET {self.offset} FROM {self.graph}")
+        parts.extend(f"PREFIX {prefix}: <{uri}>" for prefix, uri in sorted(self.prefixes.items()))
+        return "\n".join(parts)
+
+    def _canonical_clause(self, clause, sort_key) -> str:
+        parts = []
+        # Holds clauses still to write and (text,) tuples to emit as is
+        stack = [clause]
+        while stack:
+            node = stack.pop()
+            if type(node) is tuple:
+                parts.append(node[0])
+            elif isinstance(node, BGP):
+                triples = sorted((f"{t.subject} {t.predicate} {t.object} ." for t in node.triples), key=sort_key)
+                filters = sorted((f"FILTER({f.expression})" for f in node.filters), key=sort_key)
+                parts.append("BGP{" + " ".join(triples + filters) + "}")
+            elif isinstance(node, UnionOperator):
+                parts.append("UNION{")
+                stack.extend([("}",), node.right, (" ",), node.left])
+            elif isinstance(node, OptionalOperator):
+                parts.append("OPTIONAL{")
+                stack.extend([("}",), node.bgp])
+            elif isinstance(node, SubQuery):
+                parts.append(f"SUBQUERY{{{node.query._canonical_text(sort_key)}}}")
+            elif isinstance(node, GroupGraphPattern):
+                filters = sorted((f"FILTER({f.expression})" for f in node.filters), key=sort_key)
+                parts.append("GROUP{")
+                stack.extend([("".join(" " + f for f in filters) + "}",), node.pattern])
+            elif isinstance(node, list):
+                for index in range(len(node) - 1, -1, -1):
+                    stack.append(node[index])
+                    if index:
+                        stack.append((" ",))
+        return "".join(parts)
 
     def is_isomorphic(self, other: 'SPARQLQuery') -> bool:
         """
@@ -1523,114 +2364,197 @@ class SPARQLQuery:
         bool
             True if the queries are isomorphic, False otherwise.
         """
-        variable_mapping = {}
-        return self._compare_clauses(self.where_clause, other.where_clause, variable_mapping)
-
-    def _compare_clauses(self, clause1, clause2, variable_mapping) -> bool:
-        if type(clause1) != type(clause2):
+        # Cheap necessary condition first: differing fingerprints rule out isomorphism
+        # without any backtracking
+        if self._isomorphism_fingerprint() != other._isomorphism_fingerprint():
             return False
+        # Color the variables by their neighbourhoods: differing color counts rule out
+        # isomorphism, and otherwise the search only binds variables of the same color.
+        # Subqueries are compared with their own mapping, so their triples are left out.
+        colors1, colors2 = _refine_variable_colors(
+            self._flatten_where_clause()[0], other._flatten_where_clause()[0])
+        if sorted(colors1.values()) != sorted(colors2.values()):
+            return False
+        return self._compare_clauses(self.where_clause, other.where_clause, _VariableMapping(colors1, colors2))
 
-        elif isinstance(clause1, BGP):
-            return self._compare_bgps(clause1, clause2, variable_mapping)
-
-        elif isinstance(clause1, UnionOperator):
-            return self._compare_unions(clause1, clause2, variable_mapping)
-
-        elif isinstance(clause1, OptionalOperator):
-            return self._compare_optionals(clause1, clause2, variable_mapping)
-
-        elif isinstance(clause1, SubQuery):
-            return clause1.query.is_isomorphic(clause2.query)
-            
-        elif isinstance(clause1, GroupGraphPattern):
-            return self._compare_clauses(clause1.pattern, clause2.pattern, variable_mapping)
+    def _isomorphism_fingerprint(self) -> tuple:
+        """
+        Summary of the where clause that is invariant under variable renaming, triple
+        order and UNION operand order; see ``_clause_invariant``.
 
-        elif isinstance(clause1, list):
-            if len(clause1) != len(clause2):
-                return False
-            for sub1, sub2 in zip(clause1, clause2):
-                if not self._compare_clauses(sub1, sub2, variable_mapping):
-                    return False
-            return True
+        Not cached, as triple terms can be changed in place without notifying the query.
+        """
+        return _clause_invariant(self.where_clause)
 
-        else:
+    def _compare_clauses(self, clause1, clause2, variable_mapping) -> bool:
+        if type(clause1) != type(clause2):
             return False
+        comparator = _lookup_by_type(_COMPARATORS, clause1)
+        return comparator is not None and comparator(self, clause1, clause2, variable_mapping)
 
     def _compare_bgps(self, bgp1: BGP, bgp2: BGP, variable_mapping) -> bool:
-        if len(bgp1.triples) != len(bgp2.triples):
+        triples1, triples2 = bgp1.triples, bgp2.triples
+        if len(triples1) != len(triples2):
             return False
 
-        # Attempt to match triple patterns
-        used_indices = set()
-
-        def match_triples(index1, mapping):
-            if index1 == len(bgp1.triples):
-                return True  # All triples matched
-
-            tp1 = bgp1.triples[index1]
+        # Only triples with the same signature can match, so each triple of bgp1 is
+        # tried against its bucket of bgp2 rather than against all of bgp2
+        buckets = defaultdict(list)
+        by_terms = defaultdict(list)
+        for index2, tp2 in enumerate(triples2):
+            buckets[_triple_signature(tp2)].append(index2)
+            by_terms[(tp2.subject, tp2.predicate, tp2.object)].append(index2)
+        signature_counts = defaultdict(int)
+        candidates = []
+        for tp1 in triples1:
+            signature = _triple_signature(tp1)
+            bucket = buckets.get(signature)
+            if bucket is None:
+                return False
+            signature_counts[signature] += 1
+            candidates.append(bucket)
+        if any(signature_counts[signature] != len(bucket) for signature, bucket in buckets.items()):
+            return False
 
-            for index2 in range(len(bgp2.triples)):
-                if index2 in used_indices:
+        # Match the most constrained triples (fewest candidates) first
+        order = sorted(range(len(triples1)), key=lambda index1: len(candidates[index1]))
+
+        # Backtracking search with an explicit stack of choices. Bindings go straight
+        # into the shared mapping and are rolled back to the mark taken for each level.
+        start = variable_mapping.mark()
+        used = [False] * len(triples2)
+        positions = [0] * len(order)
+        chosen = [None] * len(order)
+        marks = [None] * len(order)
+        level_candidates = [None] * len(order)
+        level = 0
+        while 0 <= level < len(order):
+            if chosen[level] is not None:
+                # Coming back to this level: undo its choice before trying the next candidate
+                used[chosen[level]] = False
+                variable_mapping.rollback(marks[level])
+                chosen[level] = None
+            tp1 = triples1[order[level]]
+            if positions[level] == 0:
+                # Entering this level: if earlier levels bound all variables of tp1, its
+                # image is fixed and the candidates are found by hash lookup
+                image = self._mapped_terms(tp1, variable_mapping)
+                level_candidates[level] = (
+                    candidates[order[level]] if image is None else by_terms.get(image, ()))
+            bucket = level_candidates[level]
+            marks[level] = variable_mapping.mark()
+            while positions[level] < len(bucket):
+                index2 = bucket[positions[level]]
+                positions[level] += 1
+                if used[index2]:
                     continue
+                if self._bind_triple(tp1, triples2[index2], variable_mapping):
+                    used[index2] = True
+                    chosen[level] = index2
+                    break
+                variable_mapping.rollback(marks[level])
+            if chosen[level] is None:
+                positions[level] = 0
+                level -= 1  # Backtrack
+            else:
+                level += 1
 
-                tp2 = bgp2.triples[index2]
-
-                # Try to match tp1 and tp2 under current variable mapping
-                new_mapping = mapping.copy()
-                if self._compare_triple_patterns(tp1, tp2, new_mapping):
-                    # Triple patterns match, update variable mapping and proceed
-                    used_indices.add(index2)
-                    if match_triples(index1 + 1, new_mapping):
-                        # Found a complete match
-                        mapping.update(new_mapping)
-                        return True
-                    # Backtrack
-                    used_indices.remove(index2)
+        if level < 0:
+            variable_mapping.rollback(start)
             return False  # No match found
+        return True
 
-        return match_triples(0, variable_mapping)
-
-    def _compare_triple_patterns(self, tp1: TriplePattern, tp2: TriplePattern, variable_mapping) -> bool:
-        return (
-                self._compare_terms(tp1.subject, tp2.subject, variable_mapping) and
-                self._compare_terms(tp1.predicate, tp2.predicate, variable_mapping) and
-                self._compare_terms(tp1.object, tp2.object, variable_mapping)
-        )
+    @staticmethod
+    def _mapped_terms(tp1: TriplePattern, variable_mapping: _VariableMapping) -> Optional[tuple]:
+        """Return the terms ``tp1`` maps to, or None if one of its variables is still unbound."""
+        forward = variable_mapping.forward
+        terms = []
+        for term in (tp1.subject, tp1.predicate, tp1.object):
+            if isinstance(term, str) and term[:1] == '?':
+                bound = forward.get(term[1:])
+                if bound is None:
+                    return None
+                term = '?' + bound
+            terms.append(term)
+        return tuple(terms)
+
+    @staticmethod
+    def _bind_triple(tp1: TriplePattern, tp2: TriplePattern, variable_mapping: _VariableMapping) -> bool:
+        """
+        Bind the variables of ``tp1`` to those of ``tp2``, which must have the same signature.
+        Returns False on a conflict; bindings made before it are left for the caller to roll back.
+        """
+        for term1, term2 in ((tp1.subject, tp2.subject), (tp1.predicate, tp2.predicate), (tp1.object, tp2.object)):
+            # Constants are equal, as guaranteed by the signature
+            if isinstance(term1, str) and term1[:1] == '?' and not variable_mapping.bind(term1[1:], term2[1:]):
+                return False
+        return True
 
-    def _compare_terms(self, term1: str, term2: str, variable_mapping) -> bool:
-        if term1.startswith('?') and term2.startswith('?'):
-            var1 = term1[1:]
-            var2 = term2[1:]
+    def _compare_unions(self, union1: UnionOperator, union2: UnionOperator, variable_mapping) -> bool:
+        # UNION is associative and commutative: compare the flattened branches as a
+        # permutation match, trying only branches with the same invariant against each other
+        branches1, branches2 = union1.branches, union2.branches
+        if len(branches1) != len(branches2):
+            return False
+        candidates = defaultdict(list)
+        for index2, branch2 in enumerate(branches2):
+            candidates[_clause_invariant(branch2)].append(index2)
+        invariants1 = [_clause_invariant(branch1) for branch1 in branches1]
+        if any(invariant not in candidates for invariant in invariants1):
+            return False
 
-            if var1 in variable_mapping:
-                return variable_mapping[var1] == var2
+        # Backtracking search with an explicit stack, as in _compare_bgps
+        start = variable_mapping.mark()
+        used = [False] * len(branches2)
+        positions = [0] * len(branches1)
+        chosen = [None] * len(branches1)
+        marks = [None] * len(branches1)
+        level = 0
+        while 0 <= level < len(branches1):
+            if chosen[level] is not None:
+                used[chosen[level]] = False
+                variable_mapping.rollback(marks[level])
+                chosen[level] = None
+            branch1 = branches1[level]
+            bucket = candidates[invariants1[level]]
+            marks[level] = variable_mapping.mark()
+            while positions[level] < len(bucket):
+                index2 = bucket[positions[level]]
+                positions[level] += 1
+                if used[index2]:
+                    continue
+                if self._compare_clauses(branch1, branches2[index2], variable_mapping):
+                    used[index2] = True
+                    chosen[level] = index2
+                    break
+                variable_mapping.rollback(marks[level])
+            if chosen[level] is None:
+                positions[level] = 0
+                level -= 1  # Backtrack
             else:
-                if var2 in variable_mapping.values():
-                    return False  # var2 is already mapped to a different variable
-                variable_mapping[var1] = var2
-                return True
+                level += 1
 
-        else:
-            return term1 == term2
+        if level < 0:
+            variable_mapping.rollback(start)
+            return False
+        return True
 
-    def _compare_unions(self, union1: UnionOperator, union2: UnionOperator, variable_mapping) -> bool:
-        # Since UNION is commutative, consider both possibilities
-        mapping_copy = variable_mapping.copy()
-        if (self._compare_clauses(union1.left, union2.left, mapping_copy) and
-                self._compare_clauses(union1.right, union2.right, mapping_copy)):
-            variable_mapping.update(mapping_copy)
-            return True
+    def _compare_optionals(self, opt1: OptionalOperator, opt2: OptionalOperator, variable_mapping) -> bool:
+        return self._compare_clauses(opt1.bgp, opt2.bgp, variable_mapping)
 
-        mapping_copy = variable_mapping.copy()
-        if (self._compare_clauses(union1.left, union2.right, mapping_copy) and
-                self._compare_clauses(union1.right, union2.left, mapping_copy)):
-            variable_mapping.update(mapping_copy)
-            return True
+    def _compare_subqueries(self, subquery1: SubQuery, subquery2: SubQuery, variable_mapping) -> bool:
+        return subquery1.query.is_isomorphic(subquery2.query)
 
-        return False
+    def _compare_groups(self, group1: GroupGraphPattern, group2: GroupGraphPattern, variable_mapping) -> bool:
+        return self._compare_clauses(group1.pattern, group2.pattern, variable_mapping)
 
-    def _compare_optionals(self, opt1: OptionalOperator, opt2: OptionalOperator, variable_mapping) -> bool:
-        return self._compare_clauses(opt1.bgp, opt2.bgp, variable_mapping)
+    def _compare_lists(self, clauses1: list, clauses2: list, variable_mapping) -> bool:
+        if len(clauses1) != len(clauses2):
+            return False
+        for sub1, sub2 in zip(clauses1, clauses2):
+            if not self._compare_clauses(sub1, sub2, variable_mapping):
+                return False
+        return True
 
     def __str__(self) -> str:
         """
@@ -1725,7 +2649,7 @@ class SPARQLQuery:
         
         return "\n".join(result)
     
-    def _str_clause(self, clause, indent=2) -> List[str]:
+    def _str_clause(self, clause, indent=2, out: List[str] = None) -> List[str]:
         """
         Generate string representation of a clause in the query structure.
         
@@ -1735,65 +2659,76 @@ class SPARQLQuery:
             The clause to stringify.
         indent : int, optional
             The indentation level (default is 2).
+        out : List[str], optional
+            List to append the lines to; a new list is created if omitted.
             
         Returns
         -------
         List[str]
-            List of lines representing the clause.
-        """
-        result = []
-        prefix = " " * indent
-        
-        if isinstance(clause, BGP):
-            result.append(f"{prefix}BGP:")
-            for triple in clause.triples:
-                result.append(f"{prefix}  Triple: {triple.subject} {triple.predicate} {triple.object}")
-            # Add filters associated with this BGP
-            if clause.filters:
-                result.append(f"{prefix}  Filters:")
-                for filter in clause.filters:
-                    result.append(f"{prefix}    {filter.expression}")
-        
-        elif isinstance(clause, UnionOperator):
-            result.append(f"{prefix}UNION:")
-            result.append(f"{prefix}  Left:")
-            left_lines = self._str_clause(clause.left, indent + 4)
-            result.extend(left_lines)
-            result.append(f"{prefix}  Right:")
-            right_lines = self._str_clause(clause.right, indent + 4)
-            result.extend(right_lines)
-        
-        elif isinstance(clause, OptionalOperator):
-            result.append(f"{prefix}OPTIONAL:")
-            optional_lines = self._str_clause(clause.bgp, indent + 2)
-            result.extend(optional_lines)
-        
-        elif isinstance(clause, SubQuery):
-            result.append(f"{prefix}SUBQUERY:")
-            sub_result = clause.query.__str__().split('\n')
-            for line in sub_result[1:]:  # Skip the first line which is 'SPARQLQuery:'
-                result.append(f"{prefix}  {line}")
-        
-        elif isinstance(clause, GroupGraphPattern):
-            result.append(f"{prefix}GroupGraphPattern:")
-            group_lines = self._str_clause(clause.pattern, indent + 2)
-            result.extend(group_lines)
-            # Add filters associated with this GroupGraphPattern
-            if clause.filters:
-                result.append(f"{prefix}  Filters:")
-                for filter in clause.filters:
-                    result.append(f"{prefix}    {filter.expression}")
-        
-        elif isinstance(clause, list):
-            for i, subquery in enumerate(clause):
-                result.append(f"{prefix}GroupGraphPattern:")
-                subq_lines = self._str_clause(subquery, indent + 2)
-                result.extend(subq_lines)
-        
-        else:
-            result.append(f"{prefix}Unknown clause type: {type(clause)}")
-            
-        return result
+            List of lines representing the clause (``out``, if given).
+        """
+        if out is None:
+            out = []
+        # Holds (clause, indent) pairs still to stringify and (line, None) pairs to emit as is
+        stack = [(clause, indent)]
+        while stack:
+            node, level = stack.pop()
+            if level is None:
+                out.append(node)
+                continue
+            step = _lookup_by_type(_STR_CLAUSE_STEPS, node)
+            if step is None:
+                out.append(f"{_spaces(level)}Unknown clause type: {type(node)}")
+            else:
+                step(self, node, level, out, stack)
+        return out
+
+    # Steps of _str_clause, looked up by clause type in _STR_CLAUSE_STEPS. Each appends
+    # the lines of its node to out and pushes nested clauses and the lines that follow them.
+    def _str_bgp(self, bgp: BGP, indent: int, out: List[str], stack: list):
+        prefix = _spaces(indent)
+        out.append(f"{prefix}BGP:")
+        for triple in bgp.triples:
+            out.append(f"{prefix}  Triple: {triple.subject} {triple.predicate} {triple.object}")
+        # Add filters associated with this BGP
+        if bgp.filters:
+            out.append(f"{prefix}  Filters:")
+            for filter in bgp.filters:
+                out.append(f"{prefix}    {filter.expression}")
+
+    def _str_union(self, union: UnionOperator, indent: int, out: List[str], stack: list):
+        prefix = _spaces(indent)
+        out.append(f"{prefix}UNION:")
+        out.append(f"{prefix}  Left:")
+        stack.append((union.right, indent + 4))
+        stack.append((f"{prefix}  Right:", None))
+        stack.append((union.left, indent + 4))
+
+    def _str_optional(self, optional: OptionalOperator, indent: int, out: List[str], stack: list):
+        out.append(f"{_spaces(indent)}OPTIONAL:")
+        stack.append((optional.bgp, indent + 2))
+
+    def _str_subquery(self, subquery: SubQuery, indent: int, out: List[str], stack: list):
+        prefix = _spaces(indent)
+        out.append(f"{prefix}SUBQUERY:")
+        sub_result = subquery.query.__str__().split('\n')
+        for line in sub_result[1:]:  # Skip the first line which is 'SPARQLQuery:'
+            out.append(f"{prefix}  {line}")
+
+    def _str_group(self, group: GroupGraphPattern, indent: int, out: List[str], stack: list):
+        prefix = _spaces(indent)
+        out.append(f"{prefix}GroupGraphPattern:")
+        # Filters associated with this GroupGraphPattern follow its pattern
+        for filter in reversed(group.filters):
+            stack.append((f"{prefix}    {filter.expression}", None))
+        if group.filters:
+            stack.append((f"{prefix}  Filters:", None))
+        stack.append((group.pattern, indent + 2))
+
+    def _str_list(self, clauses: list, indent: int, out: List[str], stack: list):
+        for clause in reversed(clauses):
+            stack.append((clause, indent + 2))
+            stack.append((f"{_spaces(indent)}GroupGraphPattern:", None))
     
     # Keep the old method for backward compatibility
     def print_structure(self, indent=0):
@@ -1842,14 +2777,12 @@ class SPARQLQuery:
         """
         used_prefixes = set()
         # Find all used prefixes in the query by scanning through triples
-        triple_patterns = extract_triple_patterns(self)
-        
-        for triple in triple_patterns:
-            for component in [triple.subject, triple.predicate, triple.object]:
+        for triple in _iter_triple_patterns(self.where_clause):
+            for component in (triple.subject, triple.predicate, triple.object):
                 if component.startswith('<') and component.endswith('>'):
                     # Full IRI, no prefix used
                     continue
-                if component.startswith('?'):
+                if component[:1] == '?':
                     # Variable, no prefix used
                     continue
                 if ":" in component:
@@ -1927,6 +2860,35 @@ class SPARQLQuery:
             }
 
 
+# Type-keyed dispatch tables of the SPARQLQuery clause walkers
+_SERIALIZE_STEPS = {
+    BGP: SPARQLQuery._serialize_step_bgp,
+    UnionOperator: SPARQLQuery._serialize_step_union,
+    OptionalOperator: SPARQLQuery._serialize_step_optional,
+    SubQuery: SPARQLQuery._serialize_step_subquery,
+    GroupGraphPattern: SPARQLQuery._serialize_step_group,
+    list: SPARQLQuery._serialize_step_list,
+}
+
+_STR_CLAUSE_STEPS = {
+    BGP: SPARQLQuery._str_bgp,
+    UnionOperator: SPARQLQuery._str_union,
+    OptionalOperator: SPARQLQuery._str_optional,
+    SubQuery: SPARQLQuery._str_subquery,
+    GroupGraphPattern: SPARQLQuery._str_group,
+    list: SPARQLQuery._str_list,
+}
+
+_COMPARATORS = {
+    BGP: SPARQLQuery._compare_bgps,
+    UnionOperator: SPARQLQuery._compare_unions,
+    OptionalOperator: SPARQLQuery._compare_optionals,
+    SubQuery: SPARQLQuery._compare_subqueries,
+    GroupGraphPattern: SPARQLQuery._compare_groups,
+    list: SPARQLQuery._compare_lists,
+}
+
+
 def extract_triple_patterns(sparql_query: SPARQLQuery) -> List[TriplePattern]:
     """
     Extract all triple patterns from the SPARQLQuery object.
@@ -1947,21 +2909,25 @@ def extract_triple_patterns(sparql_query: SPARQLQuery) -> List[TriplePattern]:
 
 
 def _extract_triples_recursive(
-    clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, List[SubQuery]],
+    clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[SubQuery]],
     triples: List[TriplePattern]
 ):
-    if isinstance(clause, BGP):
-        triples.extend(clause.triples)
-    elif isinstance(clause, UnionOperator):
-        _extract_triples_recursive(clause.left, triples)
-        _extract_triples_recursive(clause.right, triples)
-    elif isinstance(clause, OptionalOperator):
-        _extract_triples_recursive(clause.bgp, triples)
-    elif isinstance(clause, SubQuery):
-        _extract_triples_recursive(clause.query.where_clause, triples)
-    elif isinstance(clause, list):
-        for subquery in clause:
-            _extract_triples_recursive(subquery, triples)
+    for component in _iter_clauses(clause, into_subqueries=True):
+        if isinstance(component, BGP):
+            triples.extend(component.triples)
+
+
+def _iter_triple_patterns(
+    clause: Union[BGP, UnionOperator, OptionalOperator, SubQuery, GroupGraphPattern, List[SubQuery]]
+):
+    """
+    Yield the triple patterns of ``clause``, including those in subqueries.
+
+    Same order as ``extract_triple_patterns``, for callers that only iterate.
+    """
+    for component in _iter_clauses(clause, into_subqueries=True):
+        if isinstance(component, BGP):
+            yield from component.triples
 
 
 def check_if_triple_all_variables(triple: TriplePattern) -> bool:
@@ -1974,7 +2940,7 @@ def check_if_triple_all_variables(triple: TriplePattern) -> bool:
     Returns:
         bool: True if all parts are variables, False otherwise.
     """
-    return all(part.startswith('?') for part in [triple.subject, triple.predicate, triple.object])
+    return triple.subject[:1] == '?' and triple.predicate[:1] == '?' and triple.object[:1] == '?'
 
 
 def get_combined_query(prefix: str, triples: List[TriplePattern]) -> str:
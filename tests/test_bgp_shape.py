@@ -90,5 +90,27 @@ class TestBGPShape(unittest.TestCase):
         bgp = BGP(triples)
         self.assertEqual(bgp.shape(), "Complex")
 
+    def test_shape_follows_changes(self):
+        # The cached shape must be recomputed when the triples change
+        bgp = BGP([
+            TriplePattern(subject="?s1", predicate="?p1", object="?o1"),
+            TriplePattern(subject="?o1", predicate="?p2", object="?o2")
+        ])
+        self.assertEqual(bgp.shape(), "Path")
+        bgp.add(TriplePattern(subject="?o2", predicate="?p3", object="?s1"))
+        self.assertEqual(bgp.shape(), "Cycle")
+        bgp.triples[2].object = "?o3"
+        self.assertEqual(bgp.shape(), "Path")
+        self.assertEqual(bgp._clone().shape(), "Path")
+
+    def test_from_arrays(self):
+        bgp = BGP.from_arrays(["?s1", "?o1", "?o2"], ["?p1", "?p2", "?p3"], ["?o1", "?o2", "?o3"])
+        self.assertEqual(len(bgp.triples), 3)
+        self.assertEqual(bgp.triples[1].subject, "?o1")
+        self.assertIs(bgp.triples[2]._parent, bgp)
+        self.assertEqual(bgp.shape(), "Path")
+        with self.assertRaises(ValueError):
+            BGP.from_arrays(["?s"], ["?p"], [])
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
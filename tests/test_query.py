@@ -8,6 +8,8 @@ from sparqlsmith import (
     Filter,
     GroupGraphPattern,
     SubQuery,
+    OrderBy,
+    QueryStatistics,
     extract_triple_patterns
 )
 from sparqlsmith.parser import SPARQLParser
@@ -99,6 +101,43 @@ class TestSPARQLQuery(unittest.TestCase):
         self.assertEqual(instantiated_query3.where_clause.triples[1].object, '28')
         self.assertEqual(instantiated_query3.where_clause.triples[2].object, '<example.org/bob>')  # URI brackets added
 
+    def test_instantiation_ignores_unused_variables(self):
+        """Test that mapping values of variables the query does not use are not interpreted"""
+        query = SPARQLQuery(
+            projection_variables=['?s', '?o', '?unused'],
+            where_clause=BGP([TriplePattern('?s', ':p', '?o')])
+        )
+        query.instantiate({'o': 'http://example.org/o', 'unused': None, '?other': 42})
+        self.assertEqual(query.where_clause.triples[0].object, '<http://example.org/o>')
+        self.assertEqual(query.projection_variables, ['?s'])
+
+    def test_filter_variables(self):
+        """Test that filter expressions take part in variable collection and instantiation"""
+        query = SPARQLQuery(
+            projection_variables=['?person', '?age'],
+            where_clause=BGP(
+                [TriplePattern('?person', '<http://example.org/age>', '?age')],
+                [Filter('?age>?min && ?person != <http://example.org/?other>')]
+            )
+        )
+        self.assertEqual(query.get_all_variables(), {'?person', '?age', '?min'})
+
+        query.instantiate({'min': '18', 'person': 'http://example.org/bob'})
+        self.assertEqual(
+            query.where_clause.filters[0].expression,
+            '?age>18 && <http://example.org/bob> != <http://example.org/?other>'
+        )
+        self.assertEqual(query.get_all_variables(), {'?age'})
+
+        # An unspaced comparison is not mistaken for an IRI
+        query = SPARQLQuery(
+            projection_variables=['?a'],
+            where_clause=BGP([TriplePattern('?a', ':p', '?c')], [Filter('?a<?b&&?c>3')])
+        )
+        self.assertEqual(query.get_all_variables(), {'?a', '?b', '?c'})
+        query.instantiate({'b': '5'})
+        self.assertEqual(query.where_clause.filters[0].expression, '?a<5&&?c>3')
+
     def test_distinct_query_serialization(self):
         """Test that the is_distinct parameter affects the query string output correctly"""
         # Create a query with is_distinct=True
@@ -137,6 +176,346 @@ class TestSPARQLQuery(unittest.TestCase):
         query_copy = query.copy(is_distinct=False)
         self.assertFalse(query_copy.is_distinct)
 
+    def test_copy_is_independent(self):
+        """Test that a copy shares no components with the original query"""
+        subquery = SPARQLQuery(where_clause=BGP([TriplePattern('?a', ':b', '?c')]))
+        query = SPARQLQuery(
+            projection_variables=['?s'],
+            where_clause=[
+                BGP([TriplePattern('?s', ':p', '?o')], [Filter('?o > 5')]),
+                UnionOperator(BGP([TriplePattern('?s', ':q', '?x')]), BGP([TriplePattern('?s', ':r', '?x')])),
+                SubQuery(subquery)
+            ],
+            order_by=OrderBy(['?s'], ascending=False),
+            limit=10
+        )
+        query_copy = query.copy()
+
+        self.assertEqual(query_copy.to_query_string(), query.to_query_string())
+        self.assertEqual(query_copy.n_triple_patterns, 4)
+        self.assertIsNot(query_copy.where_clause[0].triples[0], query.where_clause[0].triples[0])
+        self.assertIs(query_copy.where_clause[0]._parent, query_copy)
+        self.assertIs(query_copy.order_by._parent, query_copy)
+
+        # Changes to the copy do not affect the original
+        query_copy.where_clause[2].query.where_clause.triples[0].remove()
+        query_copy.order_by.add('?o')
+        self.assertEqual(query_copy.n_triple_patterns, 3)
+        self.assertEqual(query.n_triple_patterns, 4)
+        self.assertEqual(len(subquery.where_clause.triples), 1)
+        self.assertEqual(query.order_by.variables, ['?s'])
+
+    def test_order_by_directions(self):
+        """Test ORDER BY directions given as a single flag and extended with add()"""
+        query = SPARQLQuery(
+            projection_variables=['?s', '?o'],
+            where_clause=BGP([TriplePattern('?s', ':p', '?o')]),
+            order_by=OrderBy(['?s', '?o'])
+        )
+        self.assertIn("ASC ?s, ?o", str(query))
+        self.assertIn("ORDER BY ASC(?s) ASC(?o)", query.to_query_string())
+
+        query.order_by.add('?x', ascending=False)
+        self.assertEqual(query.order_by.ascending, [True, True, False])
+        self.assertIn("ASC(?s), ASC(?o), DESC(?x)", str(query))
+
+        # A direction assigned directly as a single flag
+        query.order_by.ascending = False
+        query.order_by.add('?y')
+        self.assertEqual(query.order_by.ascending, [False, False, False, True])
+
+        # The first variable added to an empty ORDER BY sets its direction
+        order_by = OrderBy([]).add('?a', ascending=False)
+        self.assertEqual(order_by.ascending, False)
+
+    def test_copy_of_replaced_triple_patterns(self):
+        """Test copying a query whose where clause contains nested lists of subqueries"""
+        query = SPARQLQuery(
+            projection_variables=['?s'],
+            where_clause=[
+                BGP([TriplePattern('?s', ':p', '?o'), TriplePattern('?o', ':q', '?x')]),
+                UnionOperator(
+                    BGP([TriplePattern('?s', ':r', '?y'), TriplePattern('?y', ':r', '?z')]),
+                    BGP([TriplePattern('?s', ':t', '?w')])
+                )
+            ]
+        )
+        replaced = query.replace_triple_patterns_with_subqueries()
+        query_copy = replaced.copy()
+        self.assertEqual(query_copy.to_query_string(), replaced.to_query_string())
+        self.assertEqual(query_copy.n_triple_patterns, 5)
+
+        # Subqueries inside list operands are wired to the copied tree
+        union = query_copy.where_clause[1]
+        self.assertIs(query_copy.where_clause[0][0]._parent, query_copy)
+        self.assertIs(union.left[0]._parent, union)
+        self.assertTrue(union.left[0].query.where_clause.triples[0].remove())
+        self.assertEqual(query_copy.n_triple_patterns, 4)
+        self.assertEqual(replaced.n_triple_patterns, 5)
+
+    def test_component_removal(self):
+        """Test that remove() detaches exactly the component it is called on"""
+        first = TriplePattern('?s', ':p', '?o')
+        duplicate = TriplePattern('?s', ':p', '?o')
+        bgp = BGP([first, duplicate])
+        bgp_filter = bgp.add('?o > 5')
+        union = UnionOperator(
+            left=BGP([TriplePattern('?s', ':q', '?x')]),
+            right=BGP([TriplePattern('?s', ':r', '?x')])
+        )
+        query = SPARQLQuery(where_clause=[bgp, union])
+        query_filter = query.add('?s != :excluded')
+
+        # Removal is by identity, not by value
+        self.assertTrue(duplicate.remove())
+        self.assertEqual(len(bgp.triples), 1)
+        self.assertIs(bgp.triples[0], first)
+
+        self.assertTrue(bgp_filter.remove())
+        self.assertEqual(bgp.filters, [])
+        self.assertTrue(query_filter.remove())
+        self.assertEqual(query.filters, [])
+
+        # Removing an operand of a UNION removes the whole UNION
+        self.assertTrue(union.left.remove())
+        self.assertEqual(len(query.where_clause), 1)
+        self.assertIs(query.where_clause[0], bgp)
+        self.assertEqual(query.where_clauses, [bgp])
+        self.assertEqual(SPARQLQuery(where_clause=bgp).where_clauses, [bgp])
+        self.assertEqual(SPARQLQuery().where_clauses, [])
+
+        # Components without a parent cannot be removed
+        self.assertFalse(TriplePattern('?a', ':b', '?c').remove())
+
+    def test_bgp_deduplication(self):
+        """Test that a BGP with dedup enabled skips duplicate triple patterns"""
+        bgp = BGP(dedup=True)
+        first = bgp.add(('?p', ':phone', '?phone'))
+        self.assertIs(bgp.add(('?p', ':phone', '?phone')), first)
+        self.assertIs(bgp.add(TriplePattern('?p', ':phone', '?phone')), first)
+        self.assertIs(bgp.add_triple('?p', ':phone', '?phone'), first)
+        bgp.add(('?phone', ':number', '?number'))
+        self.assertEqual(len(bgp.triples), 2)
+
+        # A removed triple can be added again
+        first.remove()
+        self.assertIsNot(bgp.add(('?p', ':phone', '?phone')), first)
+        self.assertEqual(len(bgp.triples), 2)
+
+        # Without dedup, duplicates are kept
+        bgp = BGP()
+        bgp.add(('?p', ':phone', '?phone'))
+        bgp.add(('?p', ':phone', '?phone'))
+        self.assertEqual(len(bgp.triples), 2)
+
+        # Duplicates passed to the constructor are dropped as well
+        triples = [
+            TriplePattern('?p', ':phone', '?phone'),
+            TriplePattern('?phone', ':number', '?number'),
+            TriplePattern('?p', ':phone', '?phone')
+        ]
+        bgp = BGP(triples, dedup=True)
+        self.assertEqual(bgp.triples, triples[:2])
+        self.assertIs(bgp.add_triple('?phone', ':number', '?number'), triples[1])
+
+    def test_bgp_deduplication_after_in_place_changes(self):
+        """Test that dedup sees triples changed in place or appended directly after reindex()"""
+        bgp = BGP(dedup=True)
+        triple = bgp.add(('?a', ':p', '?b'))
+        triple.object = '?c'
+        bgp.reindex()
+        self.assertIs(bgp.add(('?a', ':p', '?c')), triple)
+        self.assertEqual(len(bgp.triples), 1)
+        # The old terms no longer count as a duplicate
+        self.assertIsNot(bgp.add(('?a', ':p', '?b')), triple)
+        self.assertEqual(len(bgp.triples), 2)
+
+        appended = TriplePattern('?x', ':q', '?y', bgp)
+        bgp.triples.append(appended)
+        bgp.reindex()
+        self.assertIs(bgp.add(('?x', ':q', '?y')), appended)
+        self.assertEqual(len(bgp.triples), 3)
+
+        # instantiate changes the terms of the triples in place
+        bgp = BGP([TriplePattern('?a', ':p', '?b')], dedup=True)
+        query = SPARQLQuery(projection_variables=['?a', '?b'], where_clause=bgp)
+        query.instantiate({'b': 'http://x'})
+        self.assertIs(bgp.add(('?a', ':p', '<http://x>')), bgp.triples[0])
+        self.assertEqual(len(bgp.triples), 1)
+
+    def test_triple_pattern_count(self):
+        """Test that n_triple_patterns follows additions and removals"""
+        query = SPARQLQuery()
+        bgp = query.add(BGP([TriplePattern('?s', ':p', '?o')]))
+        self.assertEqual(query.n_triple_patterns, 1)
+
+        union = query.add(UnionOperator(
+            left=BGP([TriplePattern('?s', ':q', '?x')]),
+            right=BGP([TriplePattern('?s', ':r', '?x'), TriplePattern('?x', ':t', '?y')])
+        ))
+        self.assertEqual(query.n_triple_patterns, 4)
+
+        # Adding to a nested BGP updates the enclosing query
+        union.left.add(('?x', ':u', '?z'))
+        self.assertEqual(query.n_triple_patterns, 5)
+
+        outer = SPARQLQuery(where_clause=SubQuery(query))
+        self.assertEqual(outer.n_triple_patterns, 5)
+
+        bgp.triples[0].remove()
+        self.assertEqual(query.n_triple_patterns, 4)
+        self.assertEqual(outer.n_triple_patterns, 4)
+
+        union.right.remove()
+        self.assertEqual(query.n_triple_patterns, 0)
+        self.assertEqual(outer.n_triple_patterns, 0)
+
+    def test_bgp_count_follows_changes(self):
+        """Test that the BGP count follows changes to the where clause"""
+        query = SPARQLQuery(where_clause=BGP([TriplePattern('?s', ':p', '?o')]))
+        self.assertEqual(query.count_bgps(), 1)
+
+        union = query.add(UnionOperator(BGP([TriplePattern('?s', ':q', 5)]), BGP()))
+        self.assertEqual(query.count_bgps(), 3)
+        self.assertEqual(query.get_all_variables(), {'?s', '?o'})
+
+        union.remove()
+        self.assertEqual(query.count_bgps(), 1)
+
+        # Adding a pattern to a group that is already part of the query
+        group = GroupGraphPattern(None)
+        query.add(group)
+        self.assertEqual(query.count_bgps(), 1)
+        group.add(BGP([TriplePattern('?o', ':r', '?x')]))
+        self.assertEqual(query.count_bgps(), 2)
+        self.assertEqual(query.n_triple_patterns, 2)
+
+        # Assigning the where clause directly
+        query.where_clause = [BGP(), BGP(), BGP()]
+        self.assertEqual(query.count_bgps(), 3)
+
+    def test_deeply_nested_where_clause(self):
+        """Test that walking deeply nested patterns does not hit the recursion limit"""
+        depth = 1500
+        clause = BGP([TriplePattern('?s', ':p0', '?o')])
+        for i in range(1, depth):
+            clause = UnionOperator(clause, OptionalOperator(BGP([TriplePattern('?s', f':p{i}', '?o')])))
+        query = SPARQLQuery(projection_variables=['?s'], where_clause=clause)
+
+        self.assertEqual(query.n_triple_patterns, depth)
+        self.assertEqual(query.count_bgps(), depth)
+        self.assertEqual(query.get_all_variables(), {'?s', '?o'})
+        self.assertEqual([tp.predicate for tp in extract_triple_patterns(query)], [f':p{i}' for i in range(depth)])
+        self.assertEqual(query.to_query_string().count('UNION'), depth - 1)
+        self.assertEqual(str(query).count('UNION:'), depth - 1)
+        self.assertEqual(query.copy().to_query_string(), query.to_query_string())
+        self.assertEqual(query.canonical_key(), query.copy().canonical_key())
+        self.assertEqual(query.replace_triple_patterns_with_subqueries().n_triple_patterns, depth)
+
+    def test_canonical_key(self):
+        """Test that canonical keys ignore variable names and triple order"""
+        query1 = SPARQLQuery(
+            projection_variables=['?s'],
+            where_clause=BGP(
+                [TriplePattern('?s', ':knows', '?o'), TriplePattern('?o', ':name', '"Bob"')],
+                [Filter('?o != ?s')]
+            )
+        )
+        query2 = SPARQLQuery(
+            projection_variables=['?a'],
+            where_clause=BGP(
+                [TriplePattern('?b', ':name', '"Bob"'), TriplePattern('?a', ':knows', '?b')],
+                [Filter('?b != ?a')]
+            )
+        )
+        query3 = query2.copy(limit=10)
+
+        self.assertEqual(query1.canonical_key(), query2.canonical_key())
+        self.assertNotEqual(query1.canonical_key(), query3.canonical_key())
+        self.assertEqual(SubQuery(query1).canonical_key(), query1.canonical_key())
+
+    def test_canonical_key_tied_triples(self):
+        """Test canonical keys of triples and filters that look alike without their variables"""
+        def query(triples, filters):
+            return SPARQLQuery(where_clause=BGP(
+                [TriplePattern(*triple) for triple in triples], [Filter(f) for f in filters]
+            ))
+        query1 = query(
+            [('?a', ':p', '?b'), ('?c', ':p', '?d'), ('?b', ':q', '?c')],
+            ['?a > 1', '?d > 1']
+        )
+        query2 = query(
+            [('?c', ':p', '?d'), ('?a', ':p', '?b'), ('?b', ':q', '?c')],
+            ['?d > 1', '?a > 1']
+        )
+        self.assertTrue(query1.is_isomorphic(query2))
+        self.assertEqual(query1.canonical_key(), query2.canonical_key())
+        renamed = query(
+            [('?y', ':p', '?z'), ('?w', ':p', '?x'), ('?x', ':q', '?y')],
+            ['?z > 1', '?w > 1']
+        )
+        self.assertEqual(query1.canonical_key(), renamed.canonical_key())
+
+
+class TestBGPReorder(unittest.TestCase):
+    """Tests for the selectivity-based triple pattern reordering of BGPs"""
+
+    def test_bound_terms_first_without_cross_products(self):
+        """Triples with more constants come first, and each next triple joins the prefix"""
+        bgp = BGP([
+            TriplePattern('?x', '?p', '?y'),
+            TriplePattern('?z', ':knows', '?w'),
+            TriplePattern('?x', ':type', ':Person'),
+            TriplePattern('?y', ':name', '?name')
+        ])
+        bgp.reorder_by_selectivity()
+
+        self.assertEqual(
+            [(tp.subject, tp.predicate, tp.object) for tp in bgp.triples],
+            [
+                ('?x', ':type', ':Person'),
+                ('?x', '?p', '?y'),
+                ('?y', ':name', '?name'),
+                ('?z', ':knows', '?w')
+            ]
+        )
+        # Triples keep their parent reference
+        self.assertTrue(all(tp._parent is bgp for tp in bgp.triples))
+
+    def test_predicate_statistics_break_ties(self):
+        """Predicate cardinalities order triples with the same number of variables"""
+        bgp = BGP([
+            TriplePattern('?s', ':name', '?name'),
+            TriplePattern('?s', ':email', '?email'),
+            TriplePattern('?s', ':other', '?other')
+        ])
+        bgp.reorder_by_selectivity(stats={':name': 1000, ':email': 10})
+
+        self.assertEqual([tp.predicate for tp in bgp.triples], [':email', ':name', ':other'])
+
+    def test_query_statistics_hint(self):
+        """Statistics attached to the enclosing query are used when none are given"""
+        name = TriplePattern('?s', ':name', '?name')
+        email = TriplePattern('?s', ':email', '?email')
+        other = TriplePattern('?s', ':other', '?other')
+        bgp = BGP([name, email, other])
+        query = SPARQLQuery(where_clause=OptionalOperator(bgp))
+        query.stats_hint(QueryStatistics(
+            triple_card={('?s', ':other', '?other'): 1},
+            predicate_card={':name': 1000, ':email': 10, ':other': 5000}
+        ))
+        bgp.reorder_by_selectivity()
+
+        # Per-triple estimates take precedence over predicate cardinalities
+        self.assertEqual(bgp.triples, [other, email, name])
+
+        # The estimates also apply to the triples of a copy
+        query_copy = query.copy()
+        copied_bgp = query_copy.where_clause.bgp
+        copied_bgp.triples.reverse()
+        copied_bgp.reorder_by_selectivity()
+        self.assertEqual([triple.predicate for triple in copied_bgp.triples], [':other', ':email', ':name'])
+
 
 class TestQueryIsomorphism(unittest.TestCase):
     """Dedicated test class for query isomorphism functionality"""
@@ -197,6 +576,55 @@ class TestQueryIsomorphism(unittest.TestCase):
         self.assertFalse(query1.is_isomorphic(query2),
             "BGPs with different numbers of triples should not be isomorphic")
 
+    def test_large_star_bgp_isomorphism(self):
+        """Test large BGPs whose triples differ only in renaming, order or one constant"""
+        n = 20
+        star = [TriplePattern('?s', ':p', f'?o{i}') for i in range(n)]
+        query1 = SPARQLQuery(where_clause=BGP(star + [TriplePattern('?o0', ':q', ':c')]))
+
+        renamed = [TriplePattern('?x', ':p', f'?y{i}') for i in reversed(range(n))]
+        query2 = SPARQLQuery(where_clause=BGP([TriplePattern('?y7', ':q', ':c')] + renamed))
+        self.assertTrue(query1.is_isomorphic(query2))
+
+        # Only the last triple differs; this must be detected without trying all orders
+        other = [TriplePattern('?s', ':p', f'?o{i}') for i in range(n)]
+        query3 = SPARQLQuery(where_clause=BGP(other + [TriplePattern('?o0', ':q', ':d')]))
+        self.assertFalse(query1.is_isomorphic(query3))
+
+    def test_same_shape_bgp_non_isomorphism(self):
+        """Test BGPs with the same triple shapes but differently connected variables"""
+        path = SPARQLQuery(where_clause=BGP([
+            TriplePattern('?a', ':p', '?b'),
+            TriplePattern('?b', ':p', '?c')
+        ]))
+        converging = SPARQLQuery(where_clause=BGP([
+            TriplePattern('?a', ':p', '?b'),
+            TriplePattern('?c', ':p', '?b')
+        ]))
+        self.assertFalse(path.is_isomorphic(converging))
+
+        # A 6-cycle and two 3-cycles look alike variable by variable; only the search
+        # over mappings can tell them apart
+        cycle = SPARQLQuery(where_clause=BGP([
+            TriplePattern(f'?v{i}', ':p', f'?v{(i + 1) % 6}') for i in range(6)
+        ]))
+        triangles = SPARQLQuery(where_clause=BGP([
+            TriplePattern(f'?v{i}', ':p', f'?v{(i + 1) % 3 + 3 * (i // 3)}') for i in range(6)
+        ]))
+        self.assertFalse(cycle.is_isomorphic(triangles))
+        self.assertTrue(cycle.is_isomorphic(cycle.copy()))
+
+    def test_mixed_literal_types_isomorphism(self):
+        """Test isomorphism of queries with numeric and string literals in the same position"""
+        def query(var, number):
+            return SPARQLQuery(where_clause=BGP([
+                TriplePattern(var, '<p>', number),
+                TriplePattern(var, '<p>', '"a"')
+            ]))
+        self.assertTrue(query('?x', 5).is_isomorphic(query('?y', 5)))
+        self.assertFalse(query('?x', 5).is_isomorphic(query('?y', 6)))
+        self.assertFalse(query('?x', 5).is_isomorphic(query('?y', '5')))
+
     def test_constant_preservation(self):
         """Test that constants must match exactly in isomorphic queries"""
         query1 = SPARQLQuery(
@@ -274,6 +702,40 @@ class TestQueryIsomorphism(unittest.TestCase):
         self.assertTrue(query1.is_isomorphic(query2),
             "Nested unions with different structures but equivalent semantics should be isomorphic")
 
+    def test_regrouped_union_isomorphism(self):
+        """Test that UNION chains are compared regardless of how they are nested"""
+        query1 = SPARQLQuery(
+            where_clause=UnionOperator(
+                left=UnionOperator(
+                    left=BGP([TriplePattern('?a', ':p1', '?b')]),
+                    right=BGP([TriplePattern('?a', ':p2', '?b')])
+                ),
+                right=BGP([TriplePattern('?a', ':p3', '?b')])
+            )
+        )
+        query2 = SPARQLQuery(
+            where_clause=UnionOperator(
+                left=BGP([TriplePattern('?x', ':p3', '?y')]),
+                right=UnionOperator(
+                    left=BGP([TriplePattern('?x', ':p1', '?y')]),
+                    right=BGP([TriplePattern('?x', ':p2', '?y')])
+                )
+            )
+        )
+        query3 = SPARQLQuery(
+            where_clause=UnionOperator(
+                left=BGP([TriplePattern('?x', ':p3', '?y')]),
+                right=UnionOperator(
+                    left=BGP([TriplePattern('?x', ':p1', '?y')]),
+                    right=BGP([TriplePattern('?y', ':p2', '?x')])
+                )
+            )
+        )
+
+        self.assertEqual(len(query1.where_clause.branches), 3)
+        self.assertTrue(query1.is_isomorphic(query2))
+        self.assertFalse(query1.is_isomorphic(query3))
+
     def test_optional_isomorphism(self):
         """Test isomorphism with OPTIONAL patterns"""
         query1 = SPARQLQuery(